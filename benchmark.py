@@ -0,0 +1,408 @@
+"""Throughput benchmark for lastfm2spotify against a local stand-in for the Last.fm and Spotify APIs.
+
+Serves synthetic tag.gettoptracks pages and Spotify /api/token and /v1/search
+responses from a local HTTP server, with configurable latency, 429 injection,
+a server-side request ceiling and token expiry, then drives the harvest and matching phases end to end
+without spending any real API quota.
+
+Usage:
+    python benchmark.py --tags rock,pop --pages 20 --max-tracks 2000 --latency 80
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+import lastfm2spotify
+
+
+class MockAPIState:
+    """Configuration and counters shared by all request handler threads."""
+    def __init__(self, args):
+        self.pages = args.pages
+        self.tracks_per_page = args.tracks_per_page
+        self.results_per_search = args.results_per_search
+        self.overlap = args.overlap
+        self.latency = args.latency / 1000
+        self.jitter = args.jitter / 1000
+        self.rate_limit_probability = args.rate_limit_probability
+        self.retry_after = args.retry_after
+        self.token_ttl = args.token_ttl
+        self.server_rate = args.server_rate
+        self.allowance = args.server_rate  # Server-side token bucket for /v1/search
+        self.allowance_updated = time.time()
+        self.random = random.Random(args.seed)
+        self.tokens = {}  # access token -> time issued
+        self.catalogue = {"tracks": {}, "albums": {}}  # Items served by searches, for the multi-ID lookups
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    def delay(self):
+        with self.lock:
+            jitter = self.random.uniform(-self.jitter, self.jitter)
+            inject_429 = self.random.random() < self.rate_limit_probability
+        time.sleep(max(self.latency + jitter, 0))
+        return inject_429
+
+    def over_server_rate(self):
+        """True when a search exceeds the configured requests per second, like a real API ceiling."""
+        if not self.server_rate:
+            return False
+        with self.lock:
+            now = time.time()
+            self.allowance = min(self.server_rate, self.allowance + (now - self.allowance_updated) * self.server_rate)
+            self.allowance_updated = now
+            if self.allowance < 1:
+                return True
+            self.allowance -= 1
+            return False
+
+
+# Ways the same hit shows up on different tag charts; all collapse to one canonical key
+CHART_VARIANTS = (
+    lambda artist, title: (artist, title),
+    lambda artist, title: (artist.upper(), title),
+    lambda artist, title: (artist, f"{title} (feat. Guest)"),
+    lambda artist, title: (f"{artist} feat. Guest", f"{title} - 2011 Remaster"),
+)
+SHARED_HITS = 50  # Size of the pool of hits that chart under several tags
+MOCK_MARKETS = ("PL", "DE", "FR", "GB", "US", "SE", "ES", "IT", "NL", "BR", "JP", "MX")  # Markets the mock catalogue is sold in
+UNAVAILABLE_FRACTION = 0.2  # Share of (track, market) pairs the mock marks unavailable
+
+
+def synthetic_id(*parts):
+    return hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()[:22]
+
+
+def available_markets(track_id):
+    """Deterministic markets a mock track is available in."""
+    return [market for market in MOCK_MARKETS if int(synthetic_id(track_id, market)[:8], 16) / 0xFFFFFFFF >= UNAVAILABLE_FRACTION]
+
+
+class MockAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Allow keep-alive connections
+    disable_nagle_algorithm = True  # Headers and body go out separately; don't stall on delayed ACKs
+
+    def log_message(self, format, *args):
+        pass  # Keep the benchmark output readable
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        state = self.server.state
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if urlparse(self.path).path != "/api/token":
+            self.send_json(404, {"error": "not found"})
+            return
+        state.count("spotify_token")
+        state.delay()
+        token = synthetic_id("token", str(time.time()), str(random.random()))
+        with state.lock:
+            state.tokens[token] = time.time()
+        self.send_json(200, {"access_token": token, "token_type": "Bearer", "expires_in": state.token_ttl})
+
+    def do_GET(self):
+        state = self.server.state
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path == "/2.0/":
+            self.lastfm_top_tracks(state, params)
+        elif url.path == "/v1/search":
+            self.spotify_search(state, params)
+        elif url.path in ("/v1/tracks", "/v1/albums"):
+            self.spotify_lookup(state, url.path.rsplit("/", 1)[1], params)
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def lastfm_top_tracks(self, state, params):
+        state.count("lastfm")
+        if state.delay():
+            state.count("lastfm_429")
+            self.send_json(429, {"error": 29, "message": "Rate limit exceeded"})
+            return
+        tag = params.get("tag", "chart")
+        page = int(params.get("page", 1))
+        tracks = []
+        if page <= state.pages:
+            for position in range(state.tracks_per_page):
+                rank = (page - 1) * state.tracks_per_page + position
+                if rank % 100 < state.overlap * 100:
+                    hit = rank % SHARED_HITS
+                    variant = CHART_VARIANTS[int(synthetic_id(tag, str(rank)), 16) % len(CHART_VARIANTS)]
+                    artist, title = variant(f"shared artist {hit}", f"shared song {hit}")
+                else:
+                    artist, title = f"{tag} artist {rank % 97}", f"{tag} song {rank}"
+                tracks.append({"name": title, "artist": {"name": artist}})
+        self.send_json(200, {"tracks": {"track": tracks, "@attr": {"tag": tag, "page": str(page)}}})
+
+    def spotify_refused(self, state):
+        """Answer 401 for an unknown or expired token and 429 when rate limited; True if the request was refused."""
+        inject_429 = state.delay()
+        token = self.headers.get("Authorization", "").replace("Bearer ", "")
+        with state.lock:
+            issued = state.tokens.get(token)
+        if issued is None or time.time() - issued > state.token_ttl:
+            state.count("spotify_401")
+            self.send_json(401, {"error": {"status": 401, "message": "The access token expired"}})
+            return True
+        if inject_429 or state.over_server_rate():
+            state.count("spotify_429")
+            self.send_json(429, {"error": {"status": 429}}, {"Retry-After": str(state.retry_after)})
+            return True
+        return False
+
+    def spotify_search(self, state, params):
+        state.count("spotify_search")
+        if self.spotify_refused(state):
+            return
+
+        query = params.get("q", "")
+        artist = re.search(r'artist:"([^"]*)"', query)
+        title = re.search(r'track:"([^"]*)"', query)
+        artist = artist.group(1) if artist else "Unknown"
+        title = title.group(1) if title else query
+        limit = min(int(params.get("limit", 20)), state.results_per_search)
+        market = params.get("market")
+        items = []
+        for index in range(limit):
+            name = title if index % 3 else f"{title} - Live"
+            track_id = synthetic_id(artist, title, str(index))
+            markets = available_markets(track_id)
+            item = {
+                "id": track_id,
+                "name": name,
+                "popularity": (index * 17) % 100,
+                "artists": [{"id": synthetic_id(artist), "name": artist}],
+                "album": {"id": synthetic_id(artist, title, "album", str(index)), "release_date": f"{1970 + index}-01-01"},
+            }
+            # Like Spotify: a market filters the items, otherwise each lists its markets
+            if market is None:
+                item["available_markets"] = markets
+            elif market not in markets:
+                continue
+            items.append(item)
+            with state.lock:
+                state.catalogue["tracks"][track_id] = item
+                state.catalogue["albums"][item["album"]["id"]] = item["album"]
+        self.send_json(200, {"tracks": {"items": items, "total": len(items)}})
+
+
+    def spotify_lookup(self, state, kind, params):
+        """Serve /v1/tracks and /v1/albums from the catalogue, with popularity moved on since the search."""
+        state.count(f"spotify_{kind}")
+        if self.spotify_refused(state):
+            return
+        items = []
+        with state.lock:
+            for item_id in params.get("ids", "").split(","):
+                item = state.catalogue[kind].get(item_id)
+                if item is not None and kind == "tracks":
+                    item = dict(item, popularity=(item["popularity"] + 1) % 100)
+                items.append(item)
+        self.send_json(200, {kind: items})
+
+
+def start_mock_server(state):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockAPIHandler)
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def point_tool_at(server, args):
+    """Redirect lastfm2spotify to the mock server and apply the benchmark's limits."""
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    lastfm2spotify.LASTFM_API_URL = f"{base_url}/2.0/"
+    lastfm2spotify.SPOTIFY_API_URL = f"{base_url}/v1"
+    lastfm2spotify.SPOTIFY_AUTH_URL = f"{base_url}/api/token"
+    lastfm2spotify.LASTFM_REQUESTS_PER_SECOND = args.lastfm_rate
+    lastfm2spotify.SPOTIFY_WORKERS = args.workers
+    lastfm2spotify.SPOTIFY_REQUESTS_PER_SECOND = args.spotify_rate
+    lastfm2spotify.SPOTIFY_MAX_REQUESTS_PER_SECOND = args.spotify_max_rate
+    lastfm2spotify.SPOTIFY_MARKETS = args.markets.split(",") if args.markets else None
+
+
+def record_latencies(latencies):
+    """Time every HTTP request the tool makes, whichever requests entry point it uses."""
+    original_request = requests.Session.request
+
+    def timed_request(self, method, url, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return original_request(self, method, url, *args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    requests.Session.request = timed_request
+    return original_request
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def count_result_rows(filename):
+    with open(filename, "r", encoding="utf-8") as csvfile:
+        return max(sum(1 for line in csvfile if line.strip()) - 1, 0)
+
+
+def run_benchmark(args):
+    state = MockAPIState(args)
+    server = start_mock_server(state)
+    point_tool_at(server, args)
+
+    latencies = []
+    original_request = record_latencies(latencies)
+    workdir = tempfile.mkdtemp(prefix="lastfm2spotify-bench-")
+    previous_dir = os.getcwd()
+    os.chdir(workdir)
+    try:
+        tags = args.tags.split(",")
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(None if args.verbose else devnull):
+            storage = lastfm2spotify.open_storage(args.storage)
+            harvest_start = time.perf_counter()
+            try:
+                if args.streaming:
+                    lastfm2spotify.shuffle_tags(tags, args.seed)
+                    stream = lastfm2spotify.HarvestStream(tags, storage)
+                    try:
+                        lastfm2spotify.match_tracks(stream, tags, args.max_tracks, storage, compact_journal=False)
+                    finally:
+                        stream.close()
+                    harvest_time = None  # Overlaps with matching
+                    match_time = time.perf_counter() - harvest_start
+                else:
+                    lastfm2spotify.process_tags(tags, storage, seed=args.seed)
+                    harvest_time = time.perf_counter() - harvest_start
+                    harvest_latencies = len(latencies)
+
+                    match_start = time.perf_counter()
+                    lastfm2spotify.match_tracks(storage.pending_tracks(), tags, args.max_tracks, storage)
+                    match_time = time.perf_counter() - match_start
+            finally:
+                storage.close()  # The sqlite backend exports results.csv here
+            enrich_time = None
+            if args.enrich:
+                enrich_start = time.perf_counter()
+                lastfm2spotify.enrich(storage=lastfm2spotify.open_storage(args.storage))
+                enrich_time = time.perf_counter() - enrich_start
+        matched = count_result_rows(lastfm2spotify.RESULTS_FILE)
+        markets = lastfm2spotify.SPOTIFY_MARKETS or []
+        market_matches = {
+            market: count_result_rows(os.path.join(lastfm2spotify.MARKET_RESULTS_DIR, f"{market}.csv")) for market in markets
+        }
+        learned_rates = lastfm2spotify.load_rate_limit_state(lastfm2spotify.RATE_LIMIT_STATE_FILE)
+    finally:
+        os.chdir(previous_dir)
+        requests.Session.request = original_request
+        server.shutdown()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    spotify_calls = state.calls["spotify_search"] + state.calls["spotify_token"]
+    report = {
+        "mode": "streaming" if args.streaming else "two-phase",
+        "storage": args.storage,
+        "lastfm_pages": state.calls["lastfm"],
+        "harvest_seconds": round(harvest_time, 3) if harvest_time else None,
+        "harvest_pages_per_sec": round(state.calls["lastfm"] / harvest_time, 2) if harvest_time else None,
+        "matched_tracks": matched,
+        "match_seconds": round(match_time, 3),
+        "tracks_per_sec": round(matched / match_time, 2) if match_time else None,
+        "spotify_calls": spotify_calls,
+        "api_calls_per_matched_track": round(spotify_calls / matched, 3) if matched else None,
+        "harvest_duplicates_skipped": lastfm2spotify.metrics.snapshot()["counters"].get("harvest_duplicates_skipped", 0),
+        "harvest_near_duplicates": lastfm2spotify.metrics.snapshot()["counters"].get("harvest_near_duplicates", 0),
+        "injected_429": state.calls["lastfm_429"] + state.calls["spotify_429"],
+        "expired_token_401": state.calls["spotify_401"],
+        "spotify_sustained_rate": learned_rates.get("spotify", {}).get("sustained_rate"),
+        "latency_p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "phase_seconds": lastfm2spotify.metrics.snapshot()["phase_seconds"],
+    }
+    if not args.streaming:
+        report["match_latency_p50_ms"] = round(percentile(latencies[harvest_latencies:], 0.50) * 1000, 1)
+        report["match_latency_p99_ms"] = round(percentile(latencies[harvest_latencies:], 0.99) * 1000, 1)
+    if args.enrich:
+        report["enrich_seconds"] = round(enrich_time, 3)
+        report["enrich_spotify_calls"] = state.calls["spotify_tracks"] + state.calls["spotify_albums"]
+    if markets:
+        report["market_matched_tracks"] = market_matches
+        report["spotify_calls_per_market"] = round(spotify_calls / len(markets), 1)
+        report["naive_per_market_spotify_calls"] = spotify_calls * len(markets)
+    if args.keep:
+        report["workdir"] = workdir
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark lastfm2spotify against a local mock of the Last.fm and Spotify APIs.")
+    parser.add_argument("--tags", default="rock,pop,jazz", help="Comma-separated tags to harvest")
+    parser.add_argument("--pages", type=int, default=10, help="Pages served per tag before the chart runs out")
+    parser.add_argument("--tracks-per-page", type=int, default=50)
+    parser.add_argument("--overlap", type=float, default=0.0, help="Fraction of chart entries drawn from hits shared across tags, in varying spellings")
+    parser.add_argument("--results-per-search", type=int, default=10, help="Items returned per Spotify search")
+    parser.add_argument("--max-tracks", type=int, default=500, help="Number of tracks to match")
+    parser.add_argument("--latency", type=float, default=50, help="Mean response latency in milliseconds")
+    parser.add_argument("--jitter", type=float, default=10, help="Latency jitter in milliseconds")
+    parser.add_argument("--rate-limit-probability", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with injected 429s")
+    parser.add_argument("--token-ttl", type=int, default=3600, help="Seconds before a mock access token expires (401)")
+    parser.add_argument("--workers", type=int, default=lastfm2spotify.SPOTIFY_WORKERS, help="Spotify searches kept in flight")
+    parser.add_argument("--spotify-rate", type=float, default=1000, help="Spotify requests per second the adaptive limiter starts at")
+    parser.add_argument("--spotify-max-rate", type=float, default=1000, help="Spotify requests per second the adaptive limiter may probe up to")
+    parser.add_argument("--server-rate", type=float, default=0, help="Spotify searches per second the mock accepts before answering 429 (0 = unlimited)")
+    parser.add_argument("--lastfm-rate", type=float, default=1000, help="Last.fm requests per second allowed by the limiter")
+    parser.add_argument("--streaming", action="store_true", help="Benchmark the streaming pipeline instead of the two phases")
+    parser.add_argument("--enrich", action="store_true", help="Refresh the results through the batch lookup endpoints after matching")
+    parser.add_argument("--markets", help=f"Comma-separated markets for multi-market matching, from {','.join(MOCK_MARKETS)}")
+    parser.add_argument("--storage", choices=["csv", "sqlite"], default=lastfm2spotify.STORAGE_BACKEND, help="Storage backend to write to")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also append the report as a JSON line to this file")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary working directory")
+    parser.add_argument("--verbose", action="store_true", help="Show the tool's own progress output")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    report = run_benchmark(args)
+    for key, value in report.items():
+        print(f"{key:>28}: {value}")
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as output_file:
+            output_file.write(json.dumps(report) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,159 @@
 import requests
+from requests.adapters import HTTPAdapter
+import argparse
+import contextlib
 import csv
+import gzip
+import io
 import os
 import time
 import json
-import pandas as pd
 from base64 import b64encode
-from collections import deque
+from collections import Counter, defaultdict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+import queue
 import random
+import sqlite3
+import sys
+import threading
+import zlib
+
+from ranking import (
+    DEFAULT_POLICY, canonical_track_key, preprocess_artist_name, preprocess_track_title, rank_result_sets, select_spotify_track,
+    track_sort_key,
+)
 
 # Configuration for Last.fm API
 LASTFM_API_KEY = 'your_api_key'
+LASTFM_API_URL = 'http://ws.audioscrobbler.com/2.0/'
 ARTIST_FILE = 'artist.csv'
+PROCESSED_JOURNAL = 'artist.processed.log'  # Append-only log of matched tracks
+JOURNAL_CHECKPOINT_INTERVAL = 500  # Compact the journal into artist.csv every N marks
+RUN_MANIFEST_FILE = 'run_manifest.json'  # Progress of the current run; a restart after a crash resumes from it
+MANIFEST_INTERVAL = 10  # Seconds between manifest saves, on top of every checkpoint
+LASTFM_PAGE_LOG = 'lastfm_pages.jsonl'  # Last.fm pages fetched by the current run, replayed when it is resumed
+CSV_FLUSH_ROWS = 200  # Rows buffered per output file before they are written out
+CSV_FLUSH_INTERVAL = 5  # Seconds after which buffered rows are written out on the next write
+RESULTS_FILE = 'results.csv'
+RESULTS_HEADER = ["Year", "Track ID", "Track Name", "Artist ID", "Artist Name", "Album ID", "Popularity"]
+STORAGE_BACKEND = 'csv'  # 'csv' keeps the CSV files as the store; 'sqlite' keeps an indexed database in STORAGE_DB_FILE
+STORAGE_DB_FILE = 'lastfm2spotify.sqlite'  # Tracks, tags, match status and results for the sqlite backend
+STORAGE_EXPORT_CSV = True  # With the sqlite backend, write artist.csv, results.csv and the tag files at the end of a run
+SEARCH_STORE_FILE = 'searches.jsonl.gz'  # Raw Spotify search items for the offline `rematch` command; None to disable
+REMATCH_CHUNK_LINES = 2000  # Stored searches handed to a rematch worker process at a time
 TRACKS_PER_PAGE = 50  # Number of tracks to retrieve per page
+LASTFM_MAX_IN_FLIGHT = 8  # Last.fm page requests running at once across all tags
+LASTFM_PREFETCH_PAGES = 4  # Pages fetched ahead of the interleaver for each tag
+LASTFM_REQUESTS_PER_SECOND = 5  # Ceiling for the adaptive limiter; Last.fm's terms allow 5 per second
+HARVEST_SEED = None  # Set to an int to make the shuffled tag order reproducible
+STREAMING_MODE = False  # Match tracks while they are harvested instead of after the harvest
+STREAM_QUEUE_SIZE = 200  # Harvested tracks buffered between Last.fm and Spotify in streaming mode
 
 # Spotify credentials
 SPOTIFY_CLIENT_ID = 'your_spotify_client_id'
 SPOTIFY_CLIENT_SECRET = 'your_spotify_client_secret'
-
-def fetch_lastfm_top_tracks(tag, page):
+SPOTIFY_API_URL = 'https://api.spotify.com/v1'
+SPOTIFY_AUTH_URL = 'https://accounts.spotify.com/api/token'
+SPOTIFY_TOKEN_FILE = '.spotify_token.json'  # Lets a restarted run reuse a token that has not expired yet
+TOKEN_REFRESH_MARGIN = 300  # Seconds before expiry at which the token is renewed in the background
+SPOTIFY_WORKERS = 8  # Number of Spotify searches kept in flight
+SPOTIFY_REQUESTS_PER_SECOND = 70 / 30  # Starting rate until a sustained rate has been learned
+SPOTIFY_MAX_REQUESTS_PER_SECOND = 50  # The adaptive limiter never probes beyond this
+SPOTIFY_MARKET = 'PL'  # Market passed to the search endpoint
+SPOTIFY_MARKETS = None  # List of markets, e.g. ['PL', 'DE', 'FR'], to match from one market-less search per track
+MARKET_RESULTS_DIR = 'markets'  # Per-market results (<market>.csv) written in multi-market mode
+SPOTIFY_TRACK_URL = 'https://open.spotify.com/track/'
+SPOTIFY_TRACKS_PER_REQUEST = 50  # Track IDs per /v1/tracks lookup, the API maximum
+SPOTIFY_ALBUMS_PER_REQUEST = 20  # Album IDs per /v1/albums lookup, the API maximum
+ENRICH_CHUNK_ROWS = 1000  # Result rows read, looked up and written back per enrichment step
+
+# Persistent cache of Spotify search results
+MATCH_CACHE_FILE = 'spotify_cache.sqlite'
+MATCH_CACHE_TTL = 30 * 24 * 3600  # Seconds before a cached search is repeated
+MATCH_CACHE_MAX_ENTRIES = 500000  # Least recently used entries are evicted past this
+
+# HTTP connection pooling
+HTTP_POOL_CONNECTIONS = 4  # Hosts kept in the shared session's connection pool
+HTTP_POOL_MAXSIZE = 16  # Keep-alive connections per host; cover SPOTIFY_WORKERS and LASTFM_MAX_IN_FLIGHT
+HTTP_GZIP = True  # Ask both APIs for gzip-compressed responses
+
+# Adaptive rate limiting
+RATE_LIMIT_STATE_FILE = 'rate_limits.json'  # Sustained request rates learned per API, used as the next run's start
+RATE_INCREASE = 0.5  # Requests per second added for each second the limiter is the bottleneck without a 429
+RATE_DECREASE = 0.5  # Factor the request rate is multiplied by on a 429
+RATE_MIN_REQUESTS_PER_SECOND = 0.2  # Floor for repeated back-offs
+RATE_HEADROOM = 0.9  # The sustained rate is kept this far below the rate that drew a 429
+
+# Instrumentation
+METRICS_FILE = 'metrics.jsonl'  # Periodic JSON lines with phase timings and counters
+METRICS_PROMETHEUS_FILE = None  # Set to a path to also write a Prometheus text file
+METRICS_INTERVAL = 10  # Seconds between metrics snapshots
+ETA_WINDOW = 50  # Tracks covered by the moving average behind the time-remaining estimate
+LATENCY_SAMPLES = 10000  # Most recent request latencies kept per API for percentiles
+
+# Command line
+CREDENTIAL_ENV_VARS = ('LASTFM_API_KEY', 'SPOTIFY_CLIENT_ID', 'SPOTIFY_CLIENT_SECRET')  # Taken from the environment when set, keeping secrets out of config files
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def get_http_session():
+    """Return the keep-alive session shared by every Last.fm and Spotify request.
+
+    Connections are pooled per host, so serial and concurrent callers reuse
+    established TCP/TLS connections instead of handshaking for each request.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers["Accept-Encoding"] = "gzip, deflate" if HTTP_GZIP else "identity"
+            _http_session = session
+        return _http_session
+
+def fetch_lastfm_top_tracks(tag, page, limiter=None):
     """Fetch top tracks from Last.fm with retry logic."""
     if tag.lower() == "none":  # Special case for no tag
-        url = f"http://ws.audioscrobbler.com/2.0/?method=chart.gettoptracks&api_key={LASTFM_API_KEY}&format=json&page={page}"
+        url = f"{LASTFM_API_URL}?method=chart.gettoptracks&api_key={LASTFM_API_KEY}&format=json&page={page}"
     else:
-        url = f"http://ws.audioscrobbler.com/2.0/?method=tag.gettoptracks&tag={tag}&api_key={LASTFM_API_KEY}&format=json&page={page}"
+        url = f"{LASTFM_API_URL}?method=tag.gettoptracks&tag={tag}&api_key={LASTFM_API_KEY}&format=json&page={page}"
     
     retry_attempts = 5
     for attempt in range(retry_attempts):
         try:
-            response = requests.get(url)
+            if attempt > 0:
+                metrics.increment("lastfm_retries")
+            if limiter is not None:
+                with metrics.time("rate_limit_wait"):
+                    limiter.wait_for_token()
+            with metrics.request("lastfm"):
+                response = get_http_session().get(url)
+            metrics.increment("lastfm_requests")
             if response.status_code == 429:
-                wait_time = 2 ** attempt  # Exponential backoff
+                metrics.increment("lastfm_429")
+                if attempt == retry_attempts - 1:
+                    response.raise_for_status()  # Out of retries; an empty result would read as the end of the chart
+                wait_time = int(response.headers.get('Retry-After', 2 ** attempt))  # Exponential backoff without a hint
                 print(f"Rate limit reached for Last.fm. Waiting for {wait_time} seconds before retrying...")
-                time.sleep(wait_time)
+                if limiter is None:
+                    with metrics.time("rate_limit_wait"):
+                        time.sleep(wait_time)
+                else:
+                    limiter.on_rate_limited(wait_time)
                 continue
             response.raise_for_status()
+            if limiter is not None:
+                limiter.on_success()
             
             # Ensure proper parsing
             try:
-                data = response.json()
+                with metrics.time("json_parse"):
+                    data = response.json()
             except json.JSONDecodeError:
                 print(f"Invalid JSON response from Last.fm API: {response.text}")
                 raise
@@ -53,45 +169,178 @@ def fetch_lastfm_top_tracks(tag, page):
 
 
 
-def process_tags(tags):
-    """Process multiple tags and store results in artist CSV file."""
-    random.shuffle(tags)  # Randomize the order of tags
-    tag_queues = {tag: deque() for tag in tags}  # Dictionary to store queues for each tag
+class LastfmPageLog:
+    """Append-only JSON lines of the Last.fm chart pages fetched by the current run.
+
+    A resumed harvest reads its pages from here instead of requesting them
+    again, including pages that were prefetched but not yet consumed when
+    the run stopped. Only the fields the harvest uses are kept. Each line
+    goes out in a single write, so a killed run leaves at most a torn last
+    line, which is ignored.
+    """
+    def __init__(self, filename, resume=False):
+        self.pages = self.load(filename) if resume else {}
+        self.lock = threading.Lock()  # Prefetch workers write concurrently
+        self.file = open(filename, "ab" if resume else "wb", buffering=0)
+
+    @staticmethod
+    def load(filename):
+        """Read the pages logged by an interrupted run, keyed by (tag, page)."""
+        pages = {}
+        if os.path.exists(filename):
+            with open(filename, "r", encoding="utf-8") as log_file:
+                for line in log_file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    pages[(record["tag"], record["page"])] = record["tracks"]
+        return pages
+
+    def get(self, tag, page):
+        """Return the logged tracks of a page, or None if it was never fetched."""
+        return self.pages.get((tag, page))
+
+    def write(self, tag, page, tracks):
+        tracks = [{"name": track["name"], "artist": {"name": track["artist"]["name"]}} for track in tracks]
+        line = json.dumps({"tag": tag, "page": page, "tracks": tracks}, separators=(",", ":")) + "\n"
+        data = line.encode("utf-8")
+        with self.lock:
+            while data:
+                data = data[self.file.write(data):]
+
+    def close(self):
+        self.file.close()
+
+
+class LastfmPagePrefetcher:
+    """Fetches Last.fm chart pages ahead of the round-robin interleaver in process_tags.
+
+    Pages are scheduled breadth-first in the order the interleaver consumes
+    them, and handed back in that order, so the harvest output does not
+    depend on which request happens to finish first. With a `page_log`,
+    every fetched page is logged, and pages already in the log are served
+    from it without a request.
+    """
+    def __init__(self, tags, limiter, page_log=None, max_in_flight=None, prefetch_pages=None):
+        self.tags = tags
+        self.limiter = limiter
+        self.page_log = page_log
+        self.max_in_flight = max_in_flight or LASTFM_MAX_IN_FLIGHT
+        self.prefetch_pages = prefetch_pages or LASTFM_PREFETCH_PAGES
+        self.next_page = {tag: 1 for tag in tags}
+        self.pending = {tag: deque() for tag in tags}  # (page, future) pairs per tag
+        self.exhausted = set()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+
+    def schedule(self, tag_index):
+        """Top up the prefetch window, starting with the tag the interleaver needs next."""
+        in_flight = sum(len(queue) for queue in self.pending.values())
+        order = [self.tags[(tag_index + i) % len(self.tags)] for i in range(len(self.tags))]
+        for depth in range(self.prefetch_pages):
+            for tag in order:
+                if in_flight >= self.max_in_flight:
+                    return
+                if tag in self.exhausted or len(self.pending[tag]) > depth:
+                    continue
+                page = self.next_page[tag]
+                logged = self.page_log.get(tag, page) if self.page_log is not None else None
+                if logged is not None:
+                    future = Future()
+                    future.set_result(logged)
+                else:
+                    future = self.executor.submit(self.fetch, tag, page)
+                self.pending[tag].append((page, future))
+                self.next_page[tag] += 1
+                in_flight += 1
+
+    def fetch(self, tag, page):
+        tracks = fetch_lastfm_top_tracks(tag, page, self.limiter)
+        if self.page_log is not None:
+            self.page_log.write(tag, page, tracks)
+        return tracks
+
+    def get(self, tag, tag_index):
+        """Return (page, tracks) for the next unread page of `tag`."""
+        self.schedule(tag_index)
+        page, future = self.pending[tag].popleft()
+        return page, future.result()
+
+    def exhaust(self, tag):
+        """Stop fetching `tag` and drop the pages requested past its end."""
+        self.exhausted.add(tag)
+        for _, future in self.pending[tag]:
+            future.cancel()
+        self.pending[tag].clear()
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+def shuffle_tags(tags, seed=None):
+    """Strip and shuffle tags in place; the order decides how tracks are interleaved. `seed` defaults to HARVEST_SEED."""
+    tags[:] = [tag.strip() for tag in tags]
+    random.Random(HARVEST_SEED if seed is None else seed).shuffle(tags)  # Randomize the order of tags
+
+
+def process_tags(tags, storage, seed=None, manifest=None):
+    """Process multiple tags and store the harvested tracks in `storage`.
+
+    With a `manifest`, the tags keep the order it recorded and it is saved
+    as the harvest progresses.
+    """
+    if manifest is None:
+        shuffle_tags(tags, seed)
+    for _ in harvest_tracks(tags, storage, manifest):
+        if manifest is not None:
+            manifest.save_if_due()
+    if manifest is not None:
+        manifest.save()
+
+
+def harvest_tracks(tags, storage, manifest=None):
+    """Interleave the Last.fm charts of `tags` into `storage`, yielding each [artist, title] row as it is stored.
+
+    With a `manifest`, pages are logged to LASTFM_PAGE_LOG and progress is
+    recorded in the manifest. If the manifest comes from an interrupted
+    run, the harvest is replayed from that run's logged pages without
+    calling Last.fm, and rows the run already stored are not stored twice.
+    """
+    tag_queues = {tag: deque() for tag in tags}  # Dictionary to store queues for each tag; each holds less than two pages
     tag_pages = {tag: 1 for tag in tags}  # Dictionary to track the current page for each tag
-    seen_tracks = set()  # Set to keep track of seen tracks
-
-    # Check for existing tag files and load data if available
-    tag_files = {}
-    for tag in tags:
-        tag_file = f"{tag.strip()}.csv"
-        if os.path.exists(tag_file):
-            with open(tag_file, "r", encoding="utf-8") as file:
-                reader = csv.DictReader(file)
-                for row in reader:
-                    track_key = f"{row['Artist']} - {row['Title']}"
-                    if track_key not in seen_tracks:
-                        tag_queues[tag].append([row['Artist'], row['Title']])
-                        seen_tracks.add(track_key)
-            print(f"Loaded existing data from '{tag_file}'.")
-        else:
-            tag_files[tag] = open(tag_file, "a", newline="", encoding="utf-8")
-            if os.path.getsize(tag_file) == 0:  # Write headers if file is empty
-                csv.writer(tag_files[tag]).writerow(["Artist", "Title"])
-
-    # Open artist.csv for writing
-    with open(ARTIST_FILE, "a", newline="", encoding="utf-8") as artist_csvfile:
-        artist_writer = csv.writer(artist_csvfile)
-        
-        if os.path.getsize(ARTIST_FILE) == 0:  # Only write headers if file is empty
-            artist_writer.writerow(["Artist", "Title"])  # Header for the CSV file
-
+    seen_tracks = set()  # Canonical keys, so case variants, "feat." credits and remasters count as seen
+    seen_spellings = set()  # Exact (artist, title) pairs, to tell near-duplicates from plain repeats
+    resume = manifest is not None and manifest.harvest_started
+
+    # Load the tracks of tags harvested by an earlier run
+    existing = storage.begin_harvest(tags, manifest.loaded_tags if resume else None)
+    for tag, rows in existing.items():
+        for artist, title in rows:
+            track_key = canonical_track_key(artist, title)
+            if track_key not in seen_tracks:
+                tag_queues[tag].append([artist, title])
+                seen_tracks.add(track_key)
+        print(f"Loaded existing data for tag '{tag}'.")
+    if manifest is not None and not resume:
+        manifest.start_harvest({tag: len(rows) for tag, rows in existing.items()})
+
+    # Fetch pages for all tags concurrently, but consume them in round-robin order
+    limiter = AdaptiveRateLimiter("lastfm", LASTFM_REQUESTS_PER_SECOND, LASTFM_REQUESTS_PER_SECOND)
+    page_log = LastfmPageLog(LASTFM_PAGE_LOG, resume) if manifest is not None else None
+    prefetcher = LastfmPagePrefetcher(tags, limiter, page_log)
+    complete = False
+    try:
         tag_index = 0
         while True:
-            tag = tags[tag_index].strip()
+            tag = tags[tag_index]
             page = tag_pages.get(tag)
 
-            if page is not None:  # Check if the page number is valid
-                tracks_page = fetch_lastfm_top_tracks(tag, page)
+            # Only read the next page once the tag's queue is down to less than a page, so the
+            # harvest stays about a page per tag ahead of the rows taken from it
+            if page is not None and len(tag_queues[tag]) < TRACKS_PER_PAGE:
+                page, tracks_page = prefetcher.get(tag, tag_index)
+                if manifest is not None:
+                    manifest.page_read(tag, page)
                 if tracks_page:
                     # Sort tracks based on the custom key
                     sorted_tracks = sorted(tracks_page, key=track_sort_key)
@@ -99,16 +348,22 @@ def process_tags(tags):
                     tag_pages[tag] += 1  # Move to the next page for the current tag
 
                     for track in sorted_tracks:
-                        track_key = f"{track['artist']['name']} - {track['name']}"
+                        track_data = [track['artist']['name'], track['name']]
+                        track_key = canonical_track_key(*track_data)
                         if track_key not in seen_tracks:
-                            track_data = [track['artist']['name'], track['name']]
                             tag_queues[tag].append(track_data)
                             seen_tracks.add(track_key)
+                        else:
+                            metrics.increment("harvest_duplicates_skipped")
+                            if tuple(track_data) not in seen_spellings:  # An exact repeat was always skipped
+                                metrics.increment("harvest_near_duplicates")
+                        seen_spellings.add(tuple(track_data))
 
                     print(f"Retrieved {len(tracks_page)} tracks for tag '{tag}' (page {page}).")
                 else:
                     print(f"No more tracks available for tag '{tag}'.")
                     tag_pages[tag] = None  # Mark this tag as exhausted
+                    prefetcher.exhaust(tag)
 
 
             # Interleave tracks from all tags
@@ -117,420 +372,2382 @@ def process_tags(tags):
                 current_tag = tags[(tag_index + i) % len(tags)]
                 if tag_queues[current_tag]:
                     track = tag_queues[current_tag].popleft()
-                    artist_writer.writerow(track)
-                    csv.writer(tag_files.get(current_tag, None)).writerow(track)
+                    storage.add_harvested(current_tag, track)
                     any_tags_active = True
+                    yield track
 
-            if not any_tags_active:
+            if not any_tags_active and all(page is None for page in tag_pages.values()):
                 print("No more tracks available from any tag. Ending retrieval.")
+                complete = True
                 break
 
             # Move to the next tag after processing all active tags
             tag_index = (tag_index + 1) % len(tags)
-
-        # Close tag files
-        for file in tag_files.values():
-            file.close()
+    finally:
+        prefetcher.close()
+        if page_log is not None:
+            page_log.close()
+        limiter.save()
+        storage.end_harvest()
+        if complete and manifest is not None:  # Only once every harvested row has been written out
+            manifest.finish_harvest()
 
 
 def get_spotify_access_token():
-    """Request a new access token from Spotify."""
+    """Request a new access token from Spotify; returns (access_token, expires_in). Raises RuntimeError if refused."""
     auth_headers = {"Authorization": f"Basic {b64encode(f'{SPOTIFY_CLIENT_ID}:{SPOTIFY_CLIENT_SECRET}'.encode('utf-8')).decode('utf-8')}"}
     auth_data = {"grant_type": "client_credentials"}
-    auth_response = requests.post("https://accounts.spotify.com/api/token", headers=auth_headers, data=auth_data)
+    with metrics.request("spotify_auth"):
+        auth_response = get_http_session().post(SPOTIFY_AUTH_URL, headers=auth_headers, data=auth_data)
+    metrics.increment("spotify_token_requests")
     
     if auth_response.status_code != 200:
-        print("Authentication failed.")
-        exit()
+        raise RuntimeError(f"Spotify authentication failed (HTTP {auth_response.status_code}); check the client ID and secret.")
     
-    access_token = json.loads(auth_response.text)["access_token"]
-    return access_token
-
-def preprocess_track_title(title):
-    """Remove additional details from the track title."""
-    # This simple split removes details after a hyphen, if present
-    parts = title.split(' - ', 1)
-    return parts[0].strip() if parts else title.strip()
-
-def refresh_token_and_retry(request_func, *args, **kwargs):
-    """Refresh the access token and retry the request."""
-    global access_token
-    access_token = get_spotify_access_token()
-    headers = {"Authorization": f"Bearer {access_token}"}
-    return request_func(*args, **kwargs, headers=headers)
-
-def update_processed_status(filename, track_title, track_id=None):
-    """Updates the PROCESSED status in artist.csv for a given track if a valid track ID is found."""
-    df = pd.read_csv(filename, low_memory=False, encoding="utf-8")
-    if track_id:  # Only update if a valid track ID is found
-        df.loc[df['Title'] == track_title, 'PROCESSED'] = 'Yes'
-    df.to_csv(filename, index=False, encoding="utf-8")
-
-
-def remove_duplicate_tracks(filename, track_id):
-    """Checks if a track ID already exists in the results CSV."""
-    if os.path.exists(filename):
-        with open(filename, "r", encoding="utf-8") as csvfile:
-            reader = csv.reader(csvfile)
-            for row in reader:
-                if row and row[1] == track_id:
-                    return True
-    return False
-
-def get_retrieved_tracks_count(filename):
-    """Counts the number of tracks already retrieved from results.csv."""
-    if os.path.exists(filename):
-        with open(filename, "r", encoding="utf-8") as csvfile:
-            reader = csv.reader(csvfile)
-            return sum(1 for row in reader if row and row[1].startswith("https://open.spotify.com/track/"))
-    return 0
+    token_data = json.loads(auth_response.text)
+    return token_data["access_token"], token_data.get("expires_in", 3600)
+
+
+class SpotifyTokenManager:
+    """Caches the Spotify access token and renews it before it expires.
+
+    A background timer refreshes the token `refresh_margin` seconds ahead of
+    expiry, so searches never have to fail with a 401 first. Callers that
+    find the token stale at the same moment share a single refresh request,
+    and once Spotify refuses the credentials every caller gets that error
+    without asking again. The token is saved to `token_file` so a run restarted shortly after can
+    skip the auth round trip.
+    """
+    def __init__(self, token_file=None, refresh_margin=None):
+        self.token_file = token_file or SPOTIFY_TOKEN_FILE
+        self.refresh_margin = TOKEN_REFRESH_MARGIN if refresh_margin is None else refresh_margin
+        self.lock = threading.Lock()
+        self.token = None
+        self.refresh_at = 0
+        self.timer = None
+        self.error = None  # RuntimeError of a refused refresh
+        self.load()
+
+    def load(self):
+        """Pick up a token saved by an earlier run if it is still comfortably valid."""
+        if not self.token_file or not os.path.exists(self.token_file):
+            return
+        try:
+            with open(self.token_file, "r", encoding="utf-8") as token_file:
+                saved = json.load(token_file)
+        except (OSError, json.JSONDecodeError):
+            return
+        if saved.get("client_id") == SPOTIFY_CLIENT_ID and time.time() < saved.get("refresh_at", 0):
+            self.token = saved["access_token"]
+            self.refresh_at = saved["refresh_at"]
+            self.schedule_refresh()
+
+    def save(self, expires_at):
+        if not self.token_file:
+            return
+        temp_file = f"{self.token_file}.tmp"
+        # The token is a credential, so keep the file private to the user
+        descriptor = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, "w", encoding="utf-8") as token_file:
+            json.dump({"client_id": SPOTIFY_CLIENT_ID, "access_token": self.token,
+                       "expires_at": expires_at, "refresh_at": self.refresh_at}, token_file)
+        os.replace(temp_file, self.token_file)
+
+    def refresh(self):
+        """Fetch a new token; the caller must hold self.lock."""
+        if self.error is not None:
+            raise self.error
+        try:
+            token, expires_in = get_spotify_access_token()
+        except RuntimeError as e:
+            self.error = e
+            raise
+        now = time.time()
+        self.token = token
+        # Short-lived tokens are renewed after three quarters of their lifetime instead
+        self.refresh_at = now + expires_in - min(self.refresh_margin, expires_in / 4)
+        self.save(now + expires_in)
+        self.schedule_refresh()
+
+    def schedule_refresh(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = threading.Timer(max(self.refresh_at - time.time(), 0), self.refresh_in_background)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def refresh_in_background(self):
+        with self.lock:
+            if time.time() >= self.refresh_at:
+                try:
+                    self.refresh()
+                except RuntimeError:
+                    pass  # Raised to the next caller that needs a token
+
+    def get_token(self):
+        with self.lock:
+            if self.token is None or time.time() >= self.refresh_at:
+                self.refresh()
+            return self.token
+
+    def handle_unauthorized(self, rejected_token):
+        """Renew after a 401, unless another caller has already replaced the rejected token."""
+        with self.lock:
+            if self.token == rejected_token:
+                self.refresh()
+            return self.token
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+
+class BufferedCSVWriter:
+    """Append-only CSV writer that keeps its file open and writes rows in batches.
+
+    Buffered rows are handed to the OS every `flush_rows` rows or once
+    `flush_interval` seconds have passed (CSV_FLUSH_ROWS and
+    CSV_FLUSH_INTERVAL by default); with autoflush=False they only go out
+    on flush(). checkpoint() also fsyncs, so everything written before it
+    survives a crash. Each batch goes out in a single append, so several
+    writers on the same file never split each other's rows.
+    """
+    def __init__(self, filename, header=None, flush_rows=None, flush_interval=None, autoflush=True):
+        self.filename = filename
+        self.flush_rows = (flush_rows or CSV_FLUSH_ROWS) if autoflush else None
+        self.flush_interval = (flush_interval or CSV_FLUSH_INTERVAL) if autoflush else None
+        self.buffer = []
+        self.last_flush = time.time()
+        is_empty = not os.path.exists(filename) or os.path.getsize(filename) == 0
+        self.file = open(filename, "ab", buffering=0)
+        if header and is_empty:  # Write headers if file is empty
+            self.buffer.append(header)
+            self.flush()
+
+    def writerow(self, row):
+        self.buffer.append(row)
+        if self.flush_rows is not None and len(self.buffer) >= self.flush_rows:
+            self.flush()
+        elif self.flush_interval is not None and time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            with metrics.time("csv_io"):
+                text = io.StringIO()
+                csv.writer(text).writerows(self.buffer)
+                self.buffer.clear()
+                data = text.getvalue().encode("utf-8")
+                while data:
+                    data = data[self.file.write(data):]
+        self.last_flush = time.time()
+
+    def checkpoint(self):
+        self.flush()
+        with metrics.time("csv_io"):
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.checkpoint()
+        self.file.close()
+
+
+class ProcessedJournal:
+    """Append-only log of (Artist, Title) pairs that have been matched on Spotify.
+
+    Marking a track adds one line to the journal instead of rewriting
+    artist.csv. Marks are only written out at checkpoints, after the result
+    rows they describe, and the PROCESSED column is brought up to date when
+    the journal is compacted at those checkpoints and on exit.
+    """
+    def __init__(self, filename, artist_file, checkpoint_interval=None):
+        self.filename = filename
+        self.artist_file = artist_file
+        self.checkpoint_interval = checkpoint_interval or JOURNAL_CHECKPOINT_INTERVAL
+        self.processed = self.load(filename)
+        self.pending = 0
+        self.writer = BufferedCSVWriter(self.filename, autoflush=False)
+
+    @staticmethod
+    def load(filename):
+        """Replay the journal left behind by a previous run."""
+        processed = set()
+        if os.path.exists(filename):
+            with open(filename, "r", newline="", encoding="utf-8") as journal_file:
+                for row in csv.reader(journal_file):
+                    if len(row) == 2:  # Ignore a torn last line after a crash
+                        processed.add((row[0], row[1]))
+        return processed
+
+    def is_processed(self, artist, title):
+        return (artist, title) in self.processed
+
+    def mark(self, artist, title):
+        """Record a track as processed; it is written out at the next checkpoint."""
+        key = (artist, title)
+        if key in self.processed:
+            return
+        self.processed.add(key)
+        self.writer.writerow(key)
+        self.pending += 1
+
+    @property
+    def checkpoint_due(self):
+        return self.pending >= self.checkpoint_interval
+
+    def checkpoint(self):
+        """Make the marks so far durable without touching artist.csv."""
+        self.writer.checkpoint()
+        self.pending = 0
+
+    def compact(self):
+        """Fold the journal into the PROCESSED column of artist.csv and truncate it."""
+        self.writer.checkpoint()
+        if os.path.exists(self.artist_file):
+            with open(self.artist_file, "r", newline="", encoding="utf-8") as csvfile:
+                reader = csv.DictReader(csvfile)
+                fieldnames = list(reader.fieldnames or ["Artist", "Title"])
+                all_rows = list(reader)
+
+            if "PROCESSED" not in fieldnames:
+                fieldnames.append("PROCESSED")
+
+            temp_file = f"{self.artist_file}.tmp"
+            with open(temp_file, "w", newline="", encoding="utf-8") as csvfile:
+                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+                writer.writeheader()
+                for row in all_rows:
+                    if (row["Artist"], row["Title"]) in self.processed:
+                        row["PROCESSED"] = "Yes"
+                    elif not row.get("PROCESSED"):
+                        row["PROCESSED"] = "No"
+                    writer.writerow(row)
+                csvfile.flush()
+                os.fsync(csvfile.fileno())
+            os.replace(temp_file, self.artist_file)
+
+        # Everything in the journal now lives in artist.csv, so start it afresh
+        self.writer.close()
+        open(self.filename, "w").close()
+        self.writer = BufferedCSVWriter(self.filename, autoflush=False)
+        self.pending = 0
+
+    def close(self):
+        self.compact()
+        self.writer.close()
+
+
+class SearchStore:
+    """Append-only gzip JSON lines of the search items each track was matched against.
+
+    One line per searched track holds its artist, title, year, ISRC, the
+    tags it was written to, the markets it was matched for in multi-market
+    mode and the items selection saw, so `rematch` can
+    rebuild the results offline. Lines are buffered like BufferedCSVWriter;
+    checkpoint() sync-flushes the compressor and fsyncs, so a crash loses
+    at most the lines written since.
+    """
+    def __init__(self, filename, flush_rows=None):
+        self.flush_rows = flush_rows or CSV_FLUSH_ROWS
+        self.buffer = []
+        self.file = gzip.open(filename, "ab")  # Each run appends a new gzip member
+
+    def write(self, artist, title, year, isrc, tags, items, markets=None):
+        record = {"artist": artist, "title": title, "year": year, "isrc": isrc, "tags": tags, "items": items}
+        if markets:
+            record["markets"] = markets
+        self.buffer.append(json.dumps(record, separators=(",", ":")))
+        if len(self.buffer) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            with metrics.time("search_store_io"):
+                self.file.write(("\n".join(self.buffer) + "\n").encode("utf-8"))
+                self.buffer.clear()
+
+    def checkpoint(self):
+        self.flush()
+        with metrics.time("search_store_io"):
+            self.file.flush(zlib.Z_SYNC_FLUSH)
+            os.fsync(self.file.fileobj.fileno())
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def read_search_store(filename):
+    """Yield the raw lines of a search store, stopping cleanly at a torn end after a crash."""
+    try:
+        with gzip.open(filename, "rb") as store_file:
+            for line in store_file:
+                yield line
+    except (EOFError, gzip.BadGzipFile, zlib.error):
+        print(f"'{filename}' ends in an incomplete block; ignoring the rest.")
+
+
+def truncate_file(filename, size):
+    """Cut `filename` back to `size` bytes, removing it when nothing is left."""
+    if not os.path.exists(filename) or os.path.getsize(filename) <= size:
+        return
+    if size == 0:
+        os.remove(filename)
+        return
+    with open(filename, "r+b") as file:
+        file.truncate(size)
+
+
+def repair_torn_tail(filename):
+    """Drop a partial last line left by a killed writer, so appended rows start on a line of their own."""
+    if not os.path.exists(filename):
+        return
+    with open(filename, "r+b") as file:
+        data = file.read()
+        if data and not data.endswith(b"\n"):
+            file.truncate(data.rfind(b"\n") + 1)
+
+
+class CSVStorage:
+    """The original storage: artist.csv with its PROCESSED column, results.csv and one CSV per tag.
+
+    The files are the output format themselves, so nothing has to be
+    exported, but resuming and deduplicating take a pass over a file.
+    Match status is journalled (see ProcessedJournal) and folded into
+    artist.csv at checkpoints. The run manifest lives in RUN_MANIFEST_FILE
+    together with the sizes of the files results are appended to; rows
+    past those sizes are rolled back when an interrupted run resumes.
+    """
+    def __init__(self):
+        self.journal = None
+        self.compact_journal = True
+        self.results_index = None
+        self.artist_writer = None
+        self.harvest_writers = {}
+        self.written_rows = None  # {filename: rows} an interrupted harvest already wrote
+        self.compacted = None  # Tracks marked processed in artist.csv, read on first use
+        self.results_writer = None
+        self.result_tag_writers = []
+
+    def has_tracks(self):
+        return os.path.exists(ARTIST_FILE)
+
+    def reset(self):
+        """Remove the harvested tracks, the tag files and the results of earlier runs."""
+        tag_files = [f"{tag}.csv" for tag in self.existing_tags() if is_tag_file(f"{tag}.csv")]
+        for filename in [ARTIST_FILE, PROCESSED_JOURNAL, RESULTS_FILE] + tag_files:
+            if os.path.exists(filename):
+                os.remove(filename)
+                print(f"'{filename}' removed.")
+
+    def existing_tags(self):
+        return get_existing_tags()
+
+    def begin_harvest(self, tags, resume=None):
+        """Open the harvest outputs; returns {tag: [[artist, title], ...]} for tags harvested before.
+
+        When resuming, `resume` maps the tags the interrupted run loaded from
+        existing files to their row counts. The files of the other tags are
+        appended to, skipping rows that run already wrote.
+        """
+        existing = {}
+        for tag in tags:
+            tag_file = f"{tag.strip()}.csv"
+            if resume is not None and tag not in resume:
+                self.harvest_writers[tag] = BufferedCSVWriter(tag_file, header=["Artist", "Title"])
+            elif os.path.exists(tag_file):
+                with open(tag_file, "r", newline="", encoding="utf-8") as file:
+                    reader = csv.reader(file)
+                    next(reader, None)  # Header
+                    existing[tag] = [row for row in reader if len(row) == 2]  # Result rows have seven columns
+                if resume is not None:
+                    existing[tag] = existing[tag][:resume[tag]]
+            else:
+                self.harvest_writers[tag] = BufferedCSVWriter(tag_file, header=["Artist", "Title"])
+        if resume is not None:
+            self.written_rows = {}
+            for filename in [ARTIST_FILE] + [writer.filename for writer in self.harvest_writers.values()]:
+                if os.path.exists(filename):
+                    with open(filename, "r", newline="", encoding="utf-8") as file:
+                        self.written_rows[filename] = {tuple(row[:2]) for row in csv.reader(file) if len(row) in (2, 3)}
+        self.artist_writer = BufferedCSVWriter(ARTIST_FILE, header=["Artist", "Title"])
+        return existing
+
+    def add_harvested(self, tag, track):
+        if self.unwritten(ARTIST_FILE, track):
+            self.artist_writer.writerow(track)
+        # Tags loaded from an existing file are not rewritten
+        if tag in self.harvest_writers and self.unwritten(self.harvest_writers[tag].filename, track):
+            self.harvest_writers[tag].writerow(track)
+
+    def unwritten(self, filename, track):
+        """False for a row the interrupted run being resumed already wrote to `filename`."""
+        return self.written_rows is None or tuple(track) not in self.written_rows.get(filename, ())
+
+    def end_harvest(self):
+        self.artist_writer.close()
+        for writer in self.harvest_writers.values():
+            writer.close()
+        self.harvest_writers = {}
+        self.written_rows = None
+
+    def open_journal(self, compact=True):
+        if self.journal is None:
+            self.journal = ProcessedJournal(PROCESSED_JOURNAL, ARTIST_FILE)
+            if compact:  # Replay the journal of a previous run into the PROCESSED column
+                self.journal.compact()
+        return self.journal
+
+    def pending_tracks(self):
+        return read_pending_tracks(ARTIST_FILE, self.open_journal())
+
+    def begin_matching(self, tags, compact_journal=True):
+        """Open the match outputs. Pass compact_journal=False while the harvester is still writing artist.csv."""
+        initialize_results_file(RESULTS_FILE)
+        self.open_journal(compact_journal)
+        self.compact_journal = compact_journal
+        self.results_index = ResultsIndex(RESULTS_FILE)
+        self.results_writer = BufferedCSVWriter(RESULTS_FILE)
+        self.result_tag_writers = [BufferedCSVWriter(f"{tag.strip()}.csv") for tag in tags]
+
+    def result_count(self):
+        return len(self.results_index if self.results_index is not None else ResultsIndex(RESULTS_FILE))
+
+    def add_result(self, result_row):
+        # Save Spotify results into separate files based on tags
+        for tag_writer in self.result_tag_writers:
+            tag_writer.writerow(result_row)
+
+        # Append new tracks to results.csv without removing existing tracks
+        if result_row[1] not in self.results_index:
+            self.results_writer.writerow(result_row)
+            self.results_index.add(result_row[1])
+
+    def mark_processed(self, artist, title):
+        """Journal the track as processed; artist.csv is updated at checkpoints."""
+        self.journal.mark(artist, title)
+
+    def is_processed(self, artist, title):
+        if self.compacted is None:
+            self.compacted = set()
+            if os.path.exists(ARTIST_FILE):
+                with open(ARTIST_FILE, "r", newline="", encoding="utf-8") as csvfile:
+                    self.compacted = {(row["Artist"], row["Title"]) for row in csv.DictReader(csvfile) if row.get("PROCESSED") == "Yes"}
+        return self.journal.is_processed(artist, title) or (artist, title) in self.compacted
+
+    @property
+    def checkpoint_due(self):
+        return self.journal.checkpoint_due
+
+    def checkpoint(self, manifest=None):
+        """Make the output files durable, save the manifest, then record their tracks as processed."""
+        for writer in [self.results_writer] + self.result_tag_writers:
+            writer.checkpoint()
+        if manifest is not None:
+            manifest.save()
+        if self.compact_journal and self.journal.checkpoint_due:
+            self.journal.compact()
+        else:
+            self.journal.checkpoint()
+
+    def save_manifest(self, state):
+        """Write the run manifest atomically, with the current size of every file results are appended to."""
+        state["offsets"] = {
+            filename: os.path.getsize(filename) if os.path.exists(filename) else 0
+            for filename in [RESULTS_FILE] + [f"{tag}.csv" for tag in state["tags"]]
+        }
+        temp_file = f"{RUN_MANIFEST_FILE}.tmp"
+        with open(temp_file, "w", encoding="utf-8") as manifest_file:
+            json.dump(state, manifest_file)
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        os.replace(temp_file, RUN_MANIFEST_FILE)
+
+    def load_manifest(self):
+        """Return the manifest of an interrupted run, with the files rolled back to its last save."""
+        if not os.path.exists(RUN_MANIFEST_FILE):
+            return None
+        with open(RUN_MANIFEST_FILE, "r", encoding="utf-8") as manifest_file:
+            state = json.load(manifest_file)
+        for filename, size in state["offsets"].items():
+            truncate_file(filename, size)
+        for filename in [ARTIST_FILE, PROCESSED_JOURNAL] + [f"{tag}.csv" for tag in state["tags"]]:
+            repair_torn_tail(filename)
+        # Marks made just before the save may not have reached the journal
+        journal = self.open_journal(compact=False)
+        for artist, title in state["match"]["processed"]:
+            journal.mark(artist, title)
+        journal.checkpoint()
+        return state
+
+    def clear_manifest(self):
+        if os.path.exists(RUN_MANIFEST_FILE):
+            os.remove(RUN_MANIFEST_FILE)
+
+    def end_matching(self):
+        for writer in [self.results_writer] + self.result_tag_writers:
+            writer.close()
+        self.result_tag_writers = []
+
+    def result_rows(self, tag=None):
+        """Return the rows of results.csv, or the result rows of one tag file, in file order."""
+        filename = RESULTS_FILE if tag is None else f"{tag}.csv"
+        return read_result_rows(filename) if os.path.exists(filename) else []
+
+    def replace_results(self, matches, kept=()):
+        """Rewrite results.csv and the result rows of the tag files from (tags, result_row) pairs.
+
+        Existing rows whose Track ID is in `kept` stay where they are, ahead
+        of the new rows.
+        """
+        results = [RESULTS_HEADER] + [row for row in self.result_rows() if row[1] in kept]
+        tag_rows = defaultdict(list)
+        seen_track_ids = set(kept)
+        for tags, result_row in matches:
+            for tag in tags:
+                tag_rows[tag.strip()].append(result_row)
+            if result_row[1] not in seen_track_ids:
+                seen_track_ids.add(result_row[1])
+                results.append(result_row)
+        rewrite_csv(RESULTS_FILE, results)
+
+        tags = set(tag_rows) | set(self.existing_tags())
+        for tag in tags:
+            tag_file = f"{tag}.csv"
+            harvested = []
+            if os.path.exists(tag_file):
+                with open(tag_file, "r", newline="", encoding="utf-8") as csvfile:
+                    harvested = [row for row in csv.reader(csvfile) if len(row) == 2]
+            rewrite_csv(tag_file, harvested + [row for row in self.result_rows(tag) if row[1] in kept] + tag_rows[tag])
+        return len(results) - 1, len(tags)
+
+    def update_results(self, update):
+        """Stream results.csv through `update` into its replacement, then carry the new rows into the tag files.
+
+        `update` takes an iterable of result rows and yields them refreshed,
+        in order. Returns the new rows by Track ID.
+        """
+        updated = {}
+        if not os.path.exists(RESULTS_FILE):
+            return updated
+        temp_file = f"{RESULTS_FILE}.tmp"
+        with open(RESULTS_FILE, "r", newline="", encoding="utf-8") as source, \
+                open(temp_file, "w", newline="", encoding="utf-8") as target:
+            reader = csv.reader(source)
+            writer = csv.writer(target)
+            writer.writerow(next(reader, RESULTS_HEADER))
+            for result_row in update(row for row in reader if len(row) == len(RESULTS_HEADER)):
+                writer.writerow(result_row)
+                updated[result_row[1]] = result_row
+        os.replace(temp_file, RESULTS_FILE)
+        refresh_result_files([f"{tag}.csv" for tag in self.existing_tags()], updated)
+        return updated
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+
+class SQLiteStorage:
+    """Tracks, tag membership, match status and results in one indexed SQLite database.
+
+    Resuming is a query on the pending index, duplicate results are
+    rejected by the primary key and counts come from COUNT(*), so no file
+    is rescanned or rewritten during a run. Status updates are committed
+    at the same checkpoints the CSV backend uses. An empty database
+    imports an existing artist.csv, journal, results.csv and tag files,
+    and close() exports the same CSV files when `export_csv` is set. The
+    run manifest is a row of run_state, committed in the same transaction
+    as the results and status updates it describes.
+    """
+    def __init__(self, filename, export_csv=True):
+        self.filename = filename
+        self.export_on_close = export_csv
+        self.tags = []
+        self.pending = 0
+        self.lock = threading.Lock()  # The streaming harvester writes from its own thread
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(
+            "CREATE TABLE IF NOT EXISTS tracks ("
+            " id INTEGER PRIMARY KEY, artist TEXT NOT NULL, title TEXT NOT NULL,"
+            " year TEXT NOT NULL DEFAULT '', isrc TEXT NOT NULL DEFAULT '', processed INTEGER NOT NULL DEFAULT 0,"
+            " UNIQUE (artist, title));"
+            "CREATE INDEX IF NOT EXISTS tracks_pending ON tracks (processed, id);"
+            "CREATE TABLE IF NOT EXISTS track_tags (tag TEXT NOT NULL, track INTEGER NOT NULL, PRIMARY KEY (tag, track));"
+            "CREATE TABLE IF NOT EXISTS results ("
+            " track_id TEXT PRIMARY KEY, year INTEGER, track_name TEXT, artist_id TEXT,"
+            " artist_name TEXT, album_id TEXT, popularity INTEGER);"
+            "CREATE TABLE IF NOT EXISTS tag_results (id INTEGER PRIMARY KEY, tag TEXT NOT NULL, track_id TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS tag_results_tag ON tag_results (tag, id);"
+            "CREATE TABLE IF NOT EXISTS run_state (name TEXT PRIMARY KEY, value TEXT NOT NULL);"
+        )
+        if not self.has_tracks() and os.path.exists(ARTIST_FILE):
+            self.import_csv()
+
+    def has_tracks(self):
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM tracks LIMIT 1").fetchone() is not None
+
+    def reset(self):
+        tag_files = [f"{tag}.csv" for tag in self.existing_tags()]
+        with self.lock:
+            self.connection.executescript(
+                "DELETE FROM tag_results; DELETE FROM results; DELETE FROM track_tags; DELETE FROM tracks;"
+            )
+        print(f"Stored tracks and results removed from '{self.filename}'.")
+        if self.export_on_close:  # The export would outlive its rows, and an empty database imports artist.csv
+            for filename in [ARTIST_FILE, RESULTS_FILE] + tag_files:
+                if os.path.exists(filename):
+                    os.remove(filename)
+                    print(f"'{filename}' removed.")
+
+    def existing_tags(self):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT tag FROM track_tags UNION SELECT tag FROM tag_results"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def insert_track(self, artist, title, year="", isrc="", processed=False):
+        """Add a track if it is new and return its id; the caller holds self.lock."""
+        self.connection.execute(
+            "INSERT OR IGNORE INTO tracks (artist, title, year, isrc, processed) VALUES (?, ?, ?, ?, ?)",
+            (artist, title, year, isrc, int(processed)),
+        )
+        return self.connection.execute("SELECT id FROM tracks WHERE artist = ? AND title = ?", (artist, title)).fetchone()[0]
+
+    def import_csv(self):
+        """Load the files of the CSV backend, so switching backends keeps earlier runs."""
+        journalled = ProcessedJournal.load(PROCESSED_JOURNAL)
+        with self.lock:
+            with open(ARTIST_FILE, "r", newline="", encoding="utf-8") as csvfile:
+                for row in csv.DictReader(csvfile):
+                    processed = row.get("PROCESSED") == "Yes" or (row["Artist"], row["Title"]) in journalled
+                    self.insert_track(row["Artist"], row["Title"], row.get("Year") or "", row.get("ISRC") or "", processed)
+            if os.path.exists(RESULTS_FILE):
+                with open(RESULTS_FILE, "r", newline="", encoding="utf-8") as csvfile:
+                    self.connection.executemany(
+                        "INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (self.result_values(row) for row in csv.reader(csvfile)
+                         if len(row) == len(RESULTS_HEADER) and row[1].startswith(SPOTIFY_TRACK_URL)),
+                    )
+            for tag in get_existing_tags():
+                with open(f"{tag}.csv", "r", newline="", encoding="utf-8") as csvfile:
+                    for row in csv.reader(csvfile):
+                        if len(row) == 2 and row != ["Artist", "Title"]:
+                            track = self.insert_track(row[0], row[1])
+                            self.connection.execute("INSERT OR IGNORE INTO track_tags VALUES (?, ?)", (tag, track))
+                        elif len(row) == len(RESULTS_HEADER) and row[1].startswith(SPOTIFY_TRACK_URL):
+                            self.connection.execute("INSERT INTO tag_results (tag, track_id) VALUES (?, ?)", (tag, row[1]))
+            self.connection.commit()
+        print(f"Imported '{ARTIST_FILE}', '{RESULTS_FILE}' and the tag files into '{self.filename}'.")
+
+    @staticmethod
+    def result_values(result_row):
+        year, track_id_url, track_name, artist_id, artist_name, album_id, popularity = result_row
+        return (track_id_url, int(year), track_name, artist_id, artist_name, album_id, int(popularity))
+
+    def begin_harvest(self, tags, resume=None):
+        """Returns {tag: [[artist, title], ...]} for tags harvested before, in harvest order.
+
+        When resuming, `resume` maps the tags the interrupted run loaded to
+        their row counts; rows it added since are inserted again, which the
+        unique keys ignore.
+        """
+        existing = {}
+        with self.lock:
+            for tag in tags:
+                if resume is not None and tag not in resume:
+                    continue
+                rows = self.connection.execute(
+                    "SELECT tracks.artist, tracks.title FROM track_tags JOIN tracks ON tracks.id = track_tags.track "
+                    "WHERE track_tags.tag = ? ORDER BY track_tags.rowid LIMIT ?",
+                    (tag, -1 if resume is None else resume[tag]),
+                ).fetchall()
+                if rows:
+                    existing[tag] = [list(row) for row in rows]
+        return existing
+
+    def add_harvested(self, tag, track):
+        with self.lock, metrics.time("storage_io"):
+            track_id = self.insert_track(track[0], track[1])
+            self.connection.execute("INSERT OR IGNORE INTO track_tags VALUES (?, ?)", (tag, track_id))
+
+    def end_harvest(self):
+        with self.lock:
+            self.connection.commit()
+
+    def pending_tracks(self):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT artist, title, year, isrc FROM tracks WHERE processed = 0 ORDER BY id"
+            ).fetchall()
+        return [(artist, title, int(year) if year.isdigit() else year, isrc) for artist, title, year, isrc in rows]
+
+    def begin_matching(self, tags, compact_journal=True):
+        self.tags = [tag.strip() for tag in tags]
+
+    def result_count(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def add_result(self, result_row):
+        with self.lock, metrics.time("storage_io"):
+            self.connection.executemany(
+                "INSERT INTO tag_results (tag, track_id) VALUES (?, ?)", ((tag, result_row[1]) for tag in self.tags)
+            )
+            self.connection.execute("INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)", self.result_values(result_row))
+
+    def mark_processed(self, artist, title):
+        with self.lock, metrics.time("storage_io"):
+            self.connection.execute("UPDATE tracks SET processed = 1 WHERE artist = ? AND title = ?", (artist, title))
+        self.pending += 1
+
+    def is_processed(self, artist, title):
+        with self.lock:
+            row = self.connection.execute("SELECT processed FROM tracks WHERE artist = ? AND title = ?", (artist, title)).fetchone()
+        return bool(row and row[0])
+
+    @property
+    def checkpoint_due(self):
+        return self.pending >= JOURNAL_CHECKPOINT_INTERVAL
+
+    def checkpoint(self, manifest=None):
+        if manifest is not None:
+            manifest.save()  # Commits
+        else:
+            with self.lock, metrics.time("storage_io"):
+                self.connection.commit()
+        self.pending = 0
+
+    def save_manifest(self, state):
+        with self.lock, metrics.time("storage_io"):
+            self.connection.execute("INSERT OR REPLACE INTO run_state (name, value) VALUES ('manifest', ?)", (json.dumps(state),))
+            self.connection.commit()
+
+    def load_manifest(self):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM run_state WHERE name = 'manifest'").fetchone()
+        return json.loads(row[0]) if row else None
+
+    def clear_manifest(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM run_state WHERE name = 'manifest'")
+            self.connection.commit()
+
+    def end_matching(self):
+        self.checkpoint()
+
+    def replace_results(self, matches, kept=()):
+        with self.lock:
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS kept_results (track_id TEXT PRIMARY KEY)")
+            self.connection.execute("DELETE FROM kept_results")
+            self.connection.executemany("INSERT OR IGNORE INTO kept_results VALUES (?)", ((track_id,) for track_id in kept))
+            self.connection.execute("DELETE FROM results WHERE track_id NOT IN (SELECT track_id FROM kept_results)")
+            self.connection.execute("DELETE FROM tag_results WHERE track_id NOT IN (SELECT track_id FROM kept_results)")
+            tags = set()
+            for match_tags, result_row in matches:
+                tags.update(tag.strip() for tag in match_tags)
+                self.connection.executemany(
+                    "INSERT INTO tag_results (tag, track_id) VALUES (?, ?)", ((tag.strip(), result_row[1]) for tag in match_tags)
+                )
+                self.connection.execute("INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)", self.result_values(result_row))
+            self.connection.commit()
+        return self.result_count(), len(tags)
+
+    def update_results(self, update):
+        """Pass the results through `update` in rowid order, ENRICH_CHUNK_ROWS at a time; returns the new rows by Track ID."""
+        def stored_rows():
+            last_rowid = 0
+            while True:
+                with self.lock:
+                    rows = self.connection.execute(
+                        "SELECT rowid, year, track_id, track_name, artist_id, artist_name, album_id, popularity "
+                        "FROM results WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                        (last_rowid, ENRICH_CHUNK_ROWS),
+                    ).fetchall()
+                if not rows:
+                    return
+                last_rowid = rows[-1][0]
+                for row in rows:
+                    yield list(row[1:])
+
+        updated = {}
+        for result_row in update(stored_rows()):
+            track_id_url, *values = self.result_values(result_row)
+            with self.lock, metrics.time("storage_io"):
+                self.connection.execute(
+                    "UPDATE results SET year = ?, track_name = ?, artist_id = ?, artist_name = ?, album_id = ?, popularity = ? "
+                    "WHERE track_id = ?",
+                    (*values, track_id_url),
+                )
+            updated[track_id_url] = result_row
+        with self.lock:
+            self.connection.commit()
+        return updated
+
+    def result_rows(self, tag=None):
+        """Yield results.csv rows, or the result rows of one tag file, in the order they were added."""
+        if tag is None:
+            query, params = "SELECT year, track_id, track_name, artist_id, artist_name, album_id, popularity FROM results ORDER BY rowid", ()
+        else:
+            query = (
+                "SELECT results.year, results.track_id, results.track_name, results.artist_id, results.artist_name, "
+                "results.album_id, results.popularity FROM tag_results JOIN results ON results.track_id = tag_results.track_id "
+                "WHERE tag_results.tag = ? ORDER BY tag_results.id"
+            )
+            params = (tag,)
+        with self.lock:
+            rows = self.connection.execute(query, params).fetchall()
+        return [list(row) for row in rows]
+
+    def export_csv(self):
+        """Write artist.csv, results.csv and the tag files in the CSV backend's layout."""
+        with self.lock:
+            tracks = self.connection.execute("SELECT artist, title, year, isrc, processed FROM tracks ORDER BY id").fetchall()
+            harvested = defaultdict(list)
+            for tag, artist, title in self.connection.execute(
+                "SELECT track_tags.tag, tracks.artist, tracks.title FROM track_tags "
+                "JOIN tracks ON tracks.id = track_tags.track ORDER BY track_tags.rowid"
+            ):
+                harvested[tag].append([artist, title])
+        has_year = any(track[2] for track in tracks)
+        has_isrc = any(track[3] for track in tracks)
+        header = ["Artist", "Title"] + (["Year"] if has_year else []) + (["ISRC"] if has_isrc else []) + ["PROCESSED"]
+        rewrite_csv(ARTIST_FILE, [header] + [
+            [artist, title] + ([year] if has_year else []) + ([isrc] if has_isrc else []) + ["Yes" if processed else "No"]
+            for artist, title, year, isrc, processed in tracks
+        ])
+        rewrite_csv(RESULTS_FILE, [RESULTS_HEADER] + self.result_rows())
+        for tag in set(harvested) | set(self.existing_tags()):
+            rewrite_csv(f"{tag}.csv", [["Artist", "Title"]] + harvested.get(tag, []) + self.result_rows(tag))
+
+    def close(self):
+        self.checkpoint()
+        if self.export_on_close:
+            self.export_csv()
+        self.connection.close()
+
+
+def open_storage(backend=None):
+    """Create the storage backend named by STORAGE_BACKEND ('csv' or 'sqlite')."""
+    backend = backend or STORAGE_BACKEND
+    if backend == "csv":
+        return CSVStorage()
+    if backend == "sqlite":
+        return SQLiteStorage(STORAGE_DB_FILE, export_csv=STORAGE_EXPORT_CSV)
+    raise ValueError(f"Unknown storage backend '{backend}'")
+
+
+class RunManifest:
+    """Progress of the current run, saved atomically through the storage backend so a killed run resumes exactly.
+
+    Records the shuffled tag order, the last Last.fm page read per tag,
+    whether the harvest finished, and the match cursor: how many rows were
+    searched, which tracks found no match, and which were marked processed
+    since the previous save. It is saved at every checkpoint, after the
+    results it covers are durable and before their tracks are marked, and
+    every MANIFEST_INTERVAL seconds. Resuming rolls the outputs back to the
+    last save; the harvest is replayed from LASTFM_PAGE_LOG and searches
+    made after the save are answered by the match cache, so neither phase
+    repeats an API call.
+    """
+    def __init__(self, storage, state):
+        self.storage = storage
+        self.state = state
+        self.unmatched = {tuple(track) for track in state["match"]["unmatched"]}
+        self.last_save = time.time()
+        self.lock = threading.Lock()  # The streaming harvester records its progress from its own thread
+
+    @classmethod
+    def start(cls, storage, tags, max_tracks, harvest=True, streaming=False):
+        """Record a new run and save it before any work is done."""
+        state = {
+            "tags": tags,
+            "max_tracks": max_tracks,
+            "streaming": streaming,
+            "harvest": {"started": False, "complete": not harvest, "loaded": {}, "pages": {}},
+            "match": {"searched": 0, "unmatched": [], "processed": []},
+        }
+        manifest = cls(storage, state)
+        manifest.save()
+        return manifest
+
+    @classmethod
+    def load(cls, storage):
+        """Return the manifest of an interrupted run, or None if the last run completed."""
+        state = storage.load_manifest()
+        return cls(storage, state) if state is not None else None
+
+    @property
+    def harvest_started(self):
+        return self.state["harvest"]["started"]
+
+    @property
+    def loaded_tags(self):
+        return self.state["harvest"]["loaded"]
+
+    def start_harvest(self, loaded):
+        """Record the tags whose rows were loaded from an earlier harvest, with their row counts.
+
+        Saved at once, before the first page is fetched or row written; the
+        streaming matcher has not started yet at this point.
+        """
+        with self.lock:
+            self.state["harvest"].update(started=True, loaded=loaded)
+        self.save()
+
+    def page_read(self, tag, page):
+        with self.lock:
+            self.state["harvest"]["pages"][tag] = page
+
+    def finish_harvest(self):
+        with self.lock:
+            self.state["harvest"]["complete"] = True
+
+    def record_match(self, artist, title, matched):
+        with self.lock:
+            match = self.state["match"]
+            match["searched"] += 1
+            if matched:
+                match["processed"].append([artist, title])
+            else:
+                match["unmatched"].append([artist, title])
+                self.unmatched.add((artist, title))
+
+    def is_unmatched(self, artist, title):
+        """True for a track this run already searched without finding a match."""
+        return (artist, title) in self.unmatched
+
+    @property
+    def due(self):
+        return time.time() - self.last_save >= MANIFEST_INTERVAL
+
+    def save(self):
+        with self.lock:
+            state = json.loads(json.dumps(self.state))  # A copy the harvester cannot change mid-save
+            self.state["match"]["processed"] = []
+        self.storage.save_manifest(state)
+        self.last_save = time.time()
+
+    def save_if_due(self):
+        if self.due:
+            self.save()
+
+    def finish(self):
+        """Forget the run once it has completed."""
+        self.storage.clear_manifest()
+        if os.path.exists(LASTFM_PAGE_LOG):
+            os.remove(LASTFM_PAGE_LOG)
+
+
+class HarvestStream:
+    """Runs harvest_tracks on a background thread and feeds its rows to the matcher.
+
+    Rows pass through a bounded queue, so the harvester blocks once it is
+    `maxsize` tracks ahead of matching and memory stays flat however large
+    the harvest is. close() stops the harvester, e.g. once enough tracks
+    have been matched. With a `manifest`, the harvester records its
+    progress in it and the matcher saves it.
+    """
+    _done = object()
+
+    def __init__(self, tags, storage, maxsize=None, manifest=None):
+        self.queue = queue.Queue(maxsize=maxsize or STREAM_QUEUE_SIZE)
+        self.stop_event = threading.Event()
+        self.started = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, args=(tags, storage, manifest), daemon=True)
+        self.thread.start()
+        # Let the harvester create artist.csv and the tag files before anything else opens them
+        self.started.wait()
+
+    def run(self, tags, storage, manifest):
+        harvest = harvest_tracks(tags, storage, manifest)
+        try:
+            for artist, title in harvest:
+                self.started.set()
+                if not self.put((artist, title, "", "")):
+                    break
+        except Exception as e:
+            self.error = e
+        finally:
+            harvest.close()
+            self.started.set()
+            self.put(self._done)
+
+    def put(self, item):
+        """Block until the matcher takes `item`; False if the stream was closed meanwhile."""
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-def is_live_track(title):
-    """Check if the track title indicates a live version."""
-    return 'live' in title.lower()
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is self._done:
+                return
+            yield item
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+        if self.error is not None:
+            print(f"Error in harvest stream: {str(self.error)}")
+
+
+class SpotifyMatchCache:
+    """SQLite-backed cache of Spotify search results keyed on the normalized query and market.
+
+    Items are stored trimmed to the fields that track selection and the
+    results files use. Entries expire after `ttl` seconds, and once the
+    cache holds more than `max_entries` the least recently used ones are
+    evicted. Safe to share between worker threads.
+    """
+    def __init__(self, filename, ttl=None, max_entries=None):
+        self.ttl = ttl or MATCH_CACHE_TTL
+        self.max_entries = max_entries or MATCH_CACHE_MAX_ENTRIES
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS search_cache ("
+            "key TEXT PRIMARY KEY, items TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS search_cache_last_used ON search_cache (last_used)")
+        self.connection.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(artist, title, market, isrc=None):
+        """Key on the canonical artist and title so near-duplicate queries share an entry."""
+        if isrc:
+            return f"{market}\x1fisrc\x1f{isrc.strip().upper()}"
+        artist, title = canonical_track_key(artist, title)
+        return f"{market}\x1f{artist}\x1f{title}"
+
+    @staticmethod
+    def compact_item(item):
+        """Keep only the fields of a search result that are used downstream."""
+        album = item.get("album") or {}
+        compact = {
+            "id": item.get("id"),
+            "name": item.get("name"),
+            "popularity": item.get("popularity"),
+            "artists": [{"id": artist.get("id"), "name": artist.get("name")} for artist in item.get("artists", [])],
+            "album": {"id": album.get("id"), "release_date": album.get("release_date")},
+        }
+        if "available_markets" in item:  # Market-less searches, already narrowed to the requested markets
+            compact["available_markets"] = item["available_markets"]
+        return compact
+
+    def get(self, artist, title, market, isrc=None):
+        """Return the cached items for a query, or None on a miss or an expired entry."""
+        key = self.make_key(artist, title, market, isrc)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT items, created FROM search_cache WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            self.connection.execute("UPDATE search_cache SET last_used = ? WHERE key = ?", (now, key))
+            self.connection.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, artist, title, market, items, isrc=None):
+        key = self.make_key(artist, title, market, isrc)
+        now = time.time()
+        payload = json.dumps([self.compact_item(item) for item in items], separators=(",", ":"))
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO search_cache (key, items, created, last_used) VALUES (?, ?, ?, ?)",
+                (key, payload, now, now),
+            )
+            self.connection.commit()
+
+    def result_sets(self):
+        """Yield (market, artist, title, items) for every cached artist/title search.
+
+        Artist and title come back in canonical form, so a choice made with
+        ranking.rank_result_sets() over (artist, items) pairs maps back to
+        the rows whose canonical_track_key() matches. ISRC lookups are
+        skipped because their key does not record the artist.
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT key, items FROM search_cache").fetchall()
+        for key, items in rows:
+            market, artist, title = key.split("\x1f", 2)
+            if artist != "isrc":
+                yield market, artist, title, json.loads(items)
+
+    def evict(self):
+        """Drop expired entries, then the least recently used ones beyond the size cap."""
+        with self.lock:
+            self.connection.execute("DELETE FROM search_cache WHERE created < ?", (time.time() - self.ttl,))
+            excess = self.connection.execute("SELECT COUNT(*) FROM search_cache").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.connection.execute(
+                    "DELETE FROM search_cache WHERE key IN "
+                    "(SELECT key FROM search_cache ORDER BY last_used LIMIT ?)",
+                    (excess,),
+                )
+            self.connection.commit()
+
+    def close(self):
+        self.evict()
+        self.connection.close()
+
+
+class ResultsIndex:
+    """Set of the Track IDs already written to the results CSV.
+
+    The file is read once at startup and the index is updated as rows are
+    appended, so duplicate checks and the retrieved-tracks count no longer
+    rescan results.csv for every track. Each ID costs about 105 bytes
+    (the string plus its set slot), roughly 210 MB for two million results.
+    """
+    def __init__(self, filename):
+        self.track_ids = set()
+        if os.path.exists(filename):
+            with open(filename, "r", encoding="utf-8") as csvfile:
+                reader = csv.reader(csvfile)
+                for row in reader:
+                    if len(row) > 1 and row[1].startswith(SPOTIFY_TRACK_URL):
+                        self.add(row[1])
+
+    @staticmethod
+    def bare_id(track_id_url):
+        # Keep only the 22-character ID to roughly halve the memory per entry
+        return track_id_url[len(SPOTIFY_TRACK_URL):] if track_id_url.startswith(SPOTIFY_TRACK_URL) else track_id_url
+
+    def __contains__(self, track_id_url):
+        return self.bare_id(track_id_url) in self.track_ids
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    def add(self, track_id_url):
+        self.track_ids.add(self.bare_id(track_id_url))
+
+
+class MarketResults:
+    """Results for several markets from the same searches, one <market>.csv per market in MARKET_RESULTS_DIR.
+
+    Tracks are searched once without a market and every item lists the
+    markets it is available in. The track chosen over all items is kept for
+    each market that has it; only the markets that lack it are selected
+    again, from the items available there. Each file skips Track IDs it
+    already holds, like results.csv, so a resumed run adds no duplicates.
+    """
+    def __init__(self, markets):
+        self.markets = list(markets)
+        self.matched = Counter()
+        self.reselected = 0
+        self.indexes = {}
+        self.writers = {}
+        os.makedirs(MARKET_RESULTS_DIR, exist_ok=True)
+        for market in self.markets:
+            filename = os.path.join(MARKET_RESULTS_DIR, f"{market}.csv")
+            repair_torn_tail(filename)
+            self.indexes[market] = ResultsIndex(filename)
+            self.writers[market] = BufferedCSVWriter(filename, RESULTS_HEADER)
+
+    def select(self, tracks, artist, year):
+        """Write the track chosen for each market and return the first market's choice, or None."""
+        artist = preprocess_artist_name(artist)
+        best_track = select_spotify_track(tracks, artist)
+        if best_track is None:  # No item is by the artist, so no market has a match
+            return None
+        selected = {}
+        for market in self.markets:
+            if market in best_track.get("available_markets", ()):
+                selected_track = best_track
+            else:
+                self.reselected += 1
+                available = [track for track in tracks if market in track.get("available_markets", ())]
+                selected_track = select_spotify_track(available, artist)
+                if selected_track is None:
+                    continue
+            selected[market] = selected_track
+            self.matched[market] += 1
+            result_row = result_row_for(selected_track, year)
+            if result_row[1] not in self.indexes[market]:
+                self.writers[market].writerow(result_row)
+                self.indexes[market].add(result_row[1])
+        return selected.get(self.markets[0])
+
+    def checkpoint(self):
+        for writer in self.writers.values():
+            writer.checkpoint()
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+    def summary(self, api_calls):
+        """Matches per market and the Spotify calls made against running each market separately."""
+        count = len(self.markets)
+        return (
+            f"Matched per market: {', '.join(f'{market} {self.matched[market]}' for market in self.markets)}\n"
+            f"Spotify search calls: {api_calls} for {count} markets ({api_calls / count:.1f} per market); "
+            f"a separate run per market would make about {api_calls * count}\n"
+            f"Market choices re-selected because the best track was unavailable: {self.reselected}"
+        )
+
+class Metrics:
+    """Thread-safe phase timings and event counters for the harvest and matching loops.
+
+    Phase times are summed over all threads, so with concurrent workers they
+    can add up to more than the wall-clock time. Comparing them shows whether
+    a run is bound by the rate limiter, the network or the disk.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phase_seconds = defaultdict(float)
+        self.phase_calls = Counter()
+        self.counters = Counter()
+        self.latencies = defaultdict(lambda: deque(maxlen=LATENCY_SAMPLES))
+        self.started = time.time()
+        self.last_export = time.time()
+
+    @contextlib.contextmanager
+    def time(self, phase):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.phase_seconds[phase] += elapsed
+                self.phase_calls[phase] += 1
+
+    @contextlib.contextmanager
+    def request(self, api):
+        """Time an HTTP request as http_wait and keep its latency for per-API percentiles."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.phase_seconds["http_wait"] += elapsed
+                self.phase_calls["http_wait"] += 1
+                self.latencies[api].append(elapsed)
+
+    @staticmethod
+    def percentile(ordered, fraction):
+        return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "timestamp": time.time(),
+                "elapsed": round(time.time() - self.started, 3),
+                "phase_seconds": {phase: round(seconds, 3) for phase, seconds in self.phase_seconds.items()},
+                "phase_calls": dict(self.phase_calls),
+                "counters": dict(self.counters),
+                "latency_ms": {
+                    api: {
+                        "p50": round(self.percentile(ordered, 0.50) * 1000, 1),
+                        "p99": round(self.percentile(ordered, 0.99) * 1000, 1),
+                    }
+                    for api, ordered in ((api, sorted(samples)) for api, samples in self.latencies.items())
+                    if ordered
+                },
+            }
+
+    def export(self, force=False):
+        """Append a JSON line (and rewrite the Prometheus file) every METRICS_INTERVAL seconds."""
+        if not force and time.time() - self.last_export < METRICS_INTERVAL:
+            return
+        self.last_export = time.time()
+        snapshot = self.snapshot()
+        if METRICS_FILE:
+            with open(METRICS_FILE, "a", encoding="utf-8") as metrics_file:
+                metrics_file.write(json.dumps(snapshot) + "\n")
+        if METRICS_PROMETHEUS_FILE:
+            self.write_prometheus(snapshot, METRICS_PROMETHEUS_FILE)
+
+    @staticmethod
+    def write_prometheus(snapshot, filename):
+        lines = [
+            "# HELP lastfm2spotify_phase_seconds_total Time spent per phase, summed over threads.",
+            "# TYPE lastfm2spotify_phase_seconds_total counter",
+        ]
+        for phase, seconds in sorted(snapshot["phase_seconds"].items()):
+            lines.append(f'lastfm2spotify_phase_seconds_total{{phase="{phase}"}} {seconds}')
+        lines += [
+            "# HELP lastfm2spotify_events_total Requests, retries, 429s, token refreshes and matches.",
+            "# TYPE lastfm2spotify_events_total counter",
+        ]
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f'lastfm2spotify_events_total{{event="{name}"}} {value}')
+        lines += [
+            "# HELP lastfm2spotify_request_latency_ms Recent HTTP request latency per API.",
+            "# TYPE lastfm2spotify_request_latency_ms gauge",
+        ]
+        for api, quantiles in sorted(snapshot["latency_ms"].items()):
+            for quantile, value in quantiles.items():
+                lines.append(f'lastfm2spotify_request_latency_ms{{api="{api}",quantile="0.{quantile[1:]}"}} {value}')
+        # Write atomically so a textfile collector never reads a half-written file
+        temp_file = f"{filename}.tmp"
+        with open(temp_file, "w", encoding="utf-8") as prometheus_file:
+            prometheus_file.write("\n".join(lines) + "\n")
+        os.replace(temp_file, filename)
+
+    def summary(self):
+        snapshot = self.snapshot()
+        phases = ", ".join(f"{phase} {seconds:.1f}s" for phase, seconds in sorted(snapshot["phase_seconds"].items()))
+        latencies = ", ".join(
+            f"{api} p50 {quantiles['p50']}ms / p99 {quantiles['p99']}ms"
+            for api, quantiles in sorted(snapshot["latency_ms"].items())
+        )
+        return f"Time by phase: {phases}\nRequest latency: {latencies}"
+
+metrics = Metrics()
+
+
+class EwmaEta:
+    """Time-remaining estimate from an exponentially weighted moving average of the time per track."""
+    def __init__(self, window=None):
+        self.alpha = 2 / ((window or ETA_WINDOW) + 1)
+        self.average = None
+        self.last_update = time.time()
 
-def refresh_token_and_retry(request_func, *args, **kwargs):
-    """Refresh the access token and retry the request."""
-    global access_token
-    access_token = get_spotify_access_token()
-    headers = {"Authorization": f"Bearer {access_token}"}
-    return request_func(*args, **kwargs, headers=headers)
+    def update(self):
+        now = time.time()
+        elapsed = now - self.last_update
+        self.last_update = now
+        self.average = elapsed if self.average is None else self.alpha * elapsed + (1 - self.alpha) * self.average
 
-# Global variables for rate limiting
-class RateLimitState:
-    def __init__(self):
-        self.call_count = 0
-        self.start_time = time.time()
-        self.last_request_time = time.time()
-        self.requests_per_window = 70  # Spotify's rate limit
-        self.window_size = 30  # Window size in seconds
+    def remaining(self, tracks_left):
+        return (self.average or 0) * max(tracks_left, 0)
 
-rate_state = RateLimitState()
 
-def handle_rate_limiting():
-    """Handles rate limiting for Spotify API calls with a sliding window."""
-    current_time = time.time()
-    
-    # Reset counter if window has passed
-    if current_time - rate_state.start_time >= rate_state.window_size:
-        rate_state.call_count = 0
-        rate_state.start_time = current_time
-    
-    rate_state.call_count += 1
-    
-    # If we've hit the rate limit
-    if rate_state.call_count >= rate_state.requests_per_window:
-        wait_time = rate_state.window_size - (current_time - rate_state.start_time)
-        if wait_time > 0:
-            print(f"\nRate limit reached. Waiting {wait_time:.1f} seconds...")
-            # Show waiting progress
-            for remaining in range(int(wait_time), 0, -1):
-                print(f"Waiting... {remaining} seconds remaining", end='\r')
-                time.sleep(1)
-            print("\nResuming requests...")
-            
-        rate_state.call_count = 0
-        rate_state.start_time = time.time()
-    
-    # Ensure minimum delay between requests
-    time_since_last = current_time - rate_state.last_request_time
-    if time_since_last < 0.05:  # Minimum 50ms between requests
-        time.sleep(0.05 - time_since_last)
-    
-    rate_state.last_request_time = time.time()
+def spotify_get(endpoint, params, tokens, limiter=None, api="spotify_search"):
+    """GET a Spotify endpoint with token refresh, rate limiting and retries; returns the decoded JSON or None.
 
-def get_spotify_tracks(artist, title, headers):
-    """Fetch tracks from Spotify with improved rate limiting and error handling."""
-    endpoint = "https://api.spotify.com/v1/search"
-    query = f"artist:\"{artist}\" track:\"{title}\""
-    search_params = {"q": query, "type": "track", "limit": 50, "market": "PL"}
-    
+    A shared `limiter` paces concurrent workers from one budget; a 429
+    lowers its rate and its Retry-After pauses all of them. Without one,
+    requests are not paced and a 429 only delays this caller. Latencies are
+    recorded under `api`.
+    """
     max_retries = 5
     base_delay = 2
     
     for attempt in range(max_retries):
         try:
-            handle_rate_limiting()  # Apply rate limiting before request
+            if attempt > 0:
+                metrics.increment("spotify_retries")
+
+            # Apply rate limiting before request
+            if limiter is not None:
+                with metrics.time("rate_limit_wait"):
+                    limiter.wait_for_token()
             
-            response = requests.get(endpoint, headers=headers, params=search_params)
+            access_token = tokens.get_token()
+            headers = {"Authorization": f"Bearer {access_token}"}
+            with metrics.request(api):
+                response = get_http_session().get(endpoint, headers=headers, params=params)
+            metrics.increment("spotify_requests")
             
             # Handle token expiration
             if response.status_code == 401:
+                metrics.increment("spotify_401_refreshes")
                 print("Access token expired. Refreshing...")
-                new_token = get_spotify_access_token()
-                headers["Authorization"] = f"Bearer {new_token}"
+                tokens.handle_unauthorized(access_token)
                 continue
             
             # Handle rate limiting from Spotify
             if response.status_code == 429:
+                metrics.increment("spotify_429")
                 retry_after = int(response.headers.get('Retry-After', 30))
                 print(f"\nSpotify rate limit exceeded. Waiting {retry_after} seconds...")
-                time.sleep(retry_after)
+                if limiter is None:
+                    with metrics.time("rate_limit_wait"):
+                        time.sleep(retry_after)
+                else:
+                    limiter.on_rate_limited(retry_after)
                 continue
                 
             response.raise_for_status()
+            if limiter is not None:
+                limiter.on_success()
             
             try:
-                return response.json().get("tracks", {}).get("items", [])
+                with metrics.time("json_parse"):
+                    return response.json()
             except json.JSONDecodeError as e:
                 print(f"Invalid JSON response: {str(e)}")
                 print(f"Response content: {response.text[:500]}...")
-                return []
+                return None
             
         except requests.exceptions.RequestException as e:
             wait_time = base_delay ** attempt
             print(f"Request failed (attempt {attempt + 1}/{max_retries}): {str(e)}")
             if attempt < max_retries - 1:
                 print(f"Waiting {wait_time} seconds before retrying...")
-                time.sleep(wait_time)
+                with metrics.time("retry_backoff"):
+                    time.sleep(wait_time)
             else:
-                print("Max retry attempts reached. Skipping track.")
-                return []
+                print("Max retry attempts reached. Skipping.")
+                return None
     
-    return []
-
-# Token bucket rate limiter class
-class SpotifyRateLimiter:
-    def __init__(self, rate=1000, per=3600):
-        self.rate = rate  # Number of requests allowed
-        self.per = per    # Time period in seconds
-        self.tokens = rate
+    return None
+
+
+def get_spotify_tracks(artist, title, tokens, limiter=None, isrc=None, markets=None):
+    """Search Spotify for a track; see spotify_get() for rate limiting and retries.
+
+    Returns None when the search could not be completed, as opposed to an
+    empty list when Spotify genuinely has no results.
+
+    With an `isrc` the recording is looked up directly and only the single
+    best hit is requested instead of a page of fuzzy matches.
+
+    With `markets` the search is made without a market, so the items are
+    not filtered by availability; their `available_markets` lists are
+    narrowed to `markets`.
+    """
+    endpoint = f"{SPOTIFY_API_URL}/search"
+    if isrc:
+        search_params = {"q": f"isrc:{isrc}", "type": "track", "limit": 1}
+    else:
+        query = f"artist:\"{preprocess_artist_name(artist)}\" track:\"{preprocess_track_title(title)}\""
+        search_params = {"q": query, "type": "track", "limit": 50}
+    if not markets:
+        search_params["market"] = SPOTIFY_MARKET
+
+    payload = spotify_get(endpoint, search_params, tokens, limiter)
+    if payload is None:
+        return None
+    items = payload.get("tracks", {}).get("items", [])
+    if markets:
+        items = [dict(item, available_markets=[market for market in item.get("available_markets", []) if market in markets]) for item in items]
+    return items
+
+
+def get_spotify_items(kind, ids, tokens, limiter=None):
+    """Look up several 'tracks' or 'albums' by ID in one request; returns {id: item}, or None if it failed.
+
+    IDs Spotify no longer knows come back as null and are left out.
+    """
+    payload = spotify_get(f"{SPOTIFY_API_URL}/{kind}", {"ids": ",".join(ids)}, tokens, limiter, f"spotify_{kind}")
+    if payload is None:
+        return None
+    return {item["id"]: item for item in payload.get(kind, []) if item}
+
+
+def get_cached_spotify_tracks(artist, title, tokens, limiter=None, cache=None, isrc=None, lookup_stats=None, markets=None):
+    """Serve a search from the match cache, falling back to Spotify on a miss.
+
+    Rows with an ISRC are looked up by ISRC first and only fall back to the
+    artist/title query when Spotify does not know the code. Market-less
+    searches for `markets` are cached under the set of markets.
+    """
+    market = ",".join(sorted(markets)) if markets else SPOTIFY_MARKET
+    if isrc:
+        tracks = cache.get(artist, title, market, isrc) if cache is not None else None
+        if tracks is None:
+            tracks = get_spotify_tracks(artist, title, tokens, limiter, isrc, markets)
+            if cache is not None and tracks is not None:
+                cache.put(artist, title, market, tracks, isrc)
+        if tracks:
+            if lookup_stats is not None:
+                lookup_stats.record("isrc")
+            return tracks
+
+    if lookup_stats is not None:
+        lookup_stats.record("query")
+    if cache is not None:
+        tracks = cache.get(artist, title, market)
+        if tracks is not None:
+            return tracks
+
+    tracks = get_spotify_tracks(artist, title, tokens, limiter, markets=markets)
+    if cache is not None and tracks is not None:  # Failed searches are retried next run
+        cache.put(artist, title, market, tracks)
+    return tracks
+
+
+class LookupStats:
+    """Thread-safe count of how Spotify lookups were resolved (by ISRC or by query)."""
+    def __init__(self):
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def record(self, path):
+        with self.lock:
+            self.counts[path] += 1
+
+_rate_limit_state_lock = threading.Lock()
+
+def load_rate_limit_state(filename):
+    """Read the sustained rates saved by earlier runs, keyed by API name."""
+    try:
+        with open(filename, "r", encoding="utf-8") as state_file:
+            return json.load(state_file)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+# AIMD rate limiter, safe to share between worker threads
+class AdaptiveRateLimiter:
+    """Paces requests to one API and searches for the highest rate it tolerates.
+
+    While callers are held back by the limiter and responses succeed, the
+    rate grows by RATE_INCREASE requests per second every second; a 429
+    multiplies it by RATE_DECREASE and pauses every caller for the
+    Retry-After period. The 429s of requests that were already in flight
+    count as one back-off. save() stores a rate just below the one that drew
+    a 429 so the next run starts close to the real ceiling.
+    """
+    def __init__(self, name, initial_rate, max_rate, min_rate=None, state_file=None):
+        self.name = name
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate or RATE_MIN_REQUESTS_PER_SECOND, max_rate)
+        self.state_file = state_file or RATE_LIMIT_STATE_FILE
+        saved = load_rate_limit_state(self.state_file).get(name, {})
+        self.rate = min(max(saved.get("sustained_rate", initial_rate), self.min_rate), max_rate)
+        self.ceiling = None  # Smoothed rate at which 429s were seen this run
+        self.tokens = 1
         self.last_update = time.time()
-    
-    def update_tokens(self):
-        now = time.time()
-        time_passed = now - self.last_update
-        self.tokens = min(self.rate, self.tokens + time_passed * (self.rate / self.per))
+        self.last_increase = time.time()
+        self.limited_at = 0  # Last time a caller had to wait for a token
+        self.paused_until = 0  # Set from Retry-After, honoured by every caller
+        self.decrease_hold_until = 0
+        self.lock = threading.Lock()
+
+    def update_tokens(self, now):
+        # Allow at most one second's worth of requests in a burst
+        self.tokens = min(max(self.rate, 1), self.tokens + (now - self.last_update) * self.rate)
         self.last_update = now
-    
+
     def acquire(self):
-        self.update_tokens()
-        if self.tokens >= 1:
-            self.tokens -= 1
-            return True
-        return False
-    
+        with self.lock:
+            now = time.time()
+            if now < self.paused_until:
+                return False
+            self.update_tokens(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            self.limited_at = now
+            return False
+
     def wait_for_token(self):
         while not self.acquire():
-            wait_time = (1 - self.tokens) * (self.per / self.rate)
-            time.sleep(min(wait_time, 60))  # Cap maximum wait at 60 seconds
+            with self.lock:
+                wait_time = max(self.paused_until - time.time(), (1 - self.tokens) / self.rate)
+            time.sleep(min(max(wait_time, 0.01), 60))  # Cap maximum wait at 60 seconds
+
+    def on_success(self):
+        """Additive increase, but only while the limiter is what holds callers back."""
+        with self.lock:
+            now = time.time()
+            elapsed = min(now - self.last_increase, 1)
+            self.last_increase = now
+            if now - self.limited_at < 1:
+                self.rate = min(self.rate + RATE_INCREASE * elapsed, self.max_rate)
+
+    def on_rate_limited(self, retry_after):
+        """Multiplicative decrease, and hold back all callers for `retry_after` seconds."""
+        with self.lock:
+            now = time.time()
+            self.paused_until = max(self.paused_until, now + retry_after)
+            self.tokens = 0  # Don't burst straight back into the limit afterwards
+            if now < self.decrease_hold_until:
+                return
+            self.ceiling = self.rate if self.ceiling is None else (self.ceiling + self.rate) / 2
+            self.rate = max(self.rate * RATE_DECREASE, self.min_rate)
+            self.decrease_hold_until = self.paused_until + 1
+            metrics.increment(f"{self.name}_rate_decreases")
+            print(f"\n{self.name} rate limit hit; slowing to {self.rate:.2f} requests/s")
+
+    @property
+    def sustained_rate(self):
+        with self.lock:
+            if self.ceiling is None:
+                return self.rate
+            return max(min(self.ceiling * RATE_HEADROOM, self.max_rate), self.min_rate)
+
+    def save(self):
+        """Record the sustained rate so the next run starts from it."""
+        sustained_rate = self.sustained_rate
+        with _rate_limit_state_lock:  # The Last.fm and Spotify limiters may save at the same time
+            state = load_rate_limit_state(self.state_file)
+            state[self.name] = {"sustained_rate": round(sustained_rate, 3), "updated": time.time()}
+            temp_file = f"{self.state_file}.tmp"
+            with open(temp_file, "w", encoding="utf-8") as state_file:
+                json.dump(state, state_file, indent=2)
+            os.replace(temp_file, self.state_file)
+
+
+def search_spotify_tracks(rows, tokens, limiter, cache=None, lookup_stats=None, workers=None, markets=None):
+    """Search Spotify for each (artist, title, year, isrc) row with up to `workers` requests in flight.
+
+    Yields (row, tracks) pairs in input order, so results are written exactly
+    as the serial loop would have written them. A row whose canonical key
+    matches a search still in flight shares that search instead of making
+    its own; once a search completes, later near-duplicates are served by
+    the match cache.
+    """
+    workers = workers or SPOTIFY_WORKERS
+    in_flight = deque()
+    shared = {}  # Canonical key -> future of the search in flight for it
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for row in rows:
+                artist, title, _, isrc = row
+                key = isrc or canonical_track_key(artist, title)
+                future = shared.get(key)
+                if future is None:
+                    future = executor.submit(get_cached_spotify_tracks, artist, title, tokens, limiter, cache, isrc, lookup_stats, markets)
+                    shared[key] = future
+                elif lookup_stats is not None:
+                    lookup_stats.record("shared")
+                in_flight.append((row, key, future))
+                if len(in_flight) >= workers:
+                    row, key, future = in_flight.popleft()
+                    if shared.get(key) is future:
+                        del shared[key]
+                    yield row, future.result()
+            while in_flight:
+                row, key, future = in_flight.popleft()
+                yield row, future.result()
+        finally:
+            # Drop searches that were queued but are no longer needed
+            for _, _, future in in_flight:
+                future.cancel()
+
+def read_pending_tracks(artist_file, journal):
+    """Return the (artist, title, year, isrc) rows of artist_file that still need matching."""
+    tracks_to_search = []
+    with open(artist_file, "r", encoding="utf-8") as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            if row.get("PROCESSED", "No") == "No" and not journal.is_processed(row["Artist"], row["Title"]):
+                year = row.get("Year", "")
+                year = int(year) if year.isdigit() else year
+                isrc = row.get("ISRC", "")
+                tracks_to_search.append((row["Artist"], row["Title"], year, isrc))
+    return tracks_to_search
 
 def initialize_results_file(filename):
     """Ensure the results CSV file exists with headers."""
     if not os.path.exists(filename):
         with open(filename, "w", newline="", encoding="utf-8") as csvfile:
             writer = csv.writer(csvfile)
-            writer.writerow(["Year", "Track ID", "Track Name", "Artist ID", "Artist Name", "Album ID", "Popularity"])
+            writer.writerow(RESULTS_HEADER)
         print(f"'{filename}' created with headers.")
 
 def get_existing_tags():
     """Extract tags from existing CSV files in the current directory."""
-    csv_files = [f for f in os.listdir() if f.endswith('.csv') and f not in ['artist.csv', 'results.csv']]
+    csv_files = [f for f in os.listdir() if f.endswith('.csv') and f not in [ARTIST_FILE, RESULTS_FILE]]
     return [os.path.splitext(f)[0] for f in csv_files]
-def track_sort_key(track):
-    """Define the sorting criteria for selecting the track."""
-    # Check if the track has a single artist
-    has_single_artist = len(track.get("artists", [])) == 1
-
-    # Check if the track title contains a hyphen
-    has_hyphen_in_title = "-" in track.get("name", "")
-
-    # Extract release year and popularity for fallback sorting
-    album = track.get("album", {})
-    release_year = (
-        int(album.get("release_date", "0000")[:4]) if album.get("release_date") else 0
-    )
-    popularity = track.get("popularity", 0)
-
-    # Sorting order:
-    # 1. Tracks with a single artist are prioritized (`True` > `False`).
-    # 2. Tracks without a hyphen in the title are prioritized (`False` > `True` for `has_hyphen_in_title`).
-    # 3. Fallback: Older tracks by release year, then higher popularity.
-    return (not has_single_artist, has_hyphen_in_title, release_year, -popularity)
-
-
-def main():
-    global headers, access_token, api_call_count, call_start_time
-
-    # Prompt for the number of tracks to retrieve
-    while True:
-        try:
-            max_tracks = int(input("Please enter the number of Spotify tracks to retrieve: ").strip())
-            if max_tracks <= 0:
-                print("Please enter a positive integer.")
-            else:
-                break
-        except ValueError:
-            print("Invalid input. Please enter a valid number.")
-
-    # Ensure the artist.csv exists and initialize it if needed
-    initialize_results_file("results.csv")
-
-    if os.path.exists(ARTIST_FILE):
-        remove_file = input(f"'{ARTIST_FILE}' already exists. Do you want to remove it? (y/n): ").strip().lower()
-        if remove_file == 'y':
-            os.remove(ARTIST_FILE)
-            print(f"'{ARTIST_FILE}' removed.")
-            if os.path.exists("results.csv"):
-                os.remove("results.csv")
-                print("'results.csv' removed.")
-            tags_input = input("Please enter the tags to search for (e.g., 'rock,pop'): ").strip()
-            tags = tags_input.split(',')
-            try:
-                process_tags(tags)
-            except Exception as e:
-                print(f"Error in main (code1): {str(e)}")
-        else:
-            print(f"'{ARTIST_FILE}' will not be removed. Proceeding with existing data.")
-            # Get tags from existing files when resuming
-            tags = get_existing_tags()
-            if not tags:
-                print("Warning: No existing tag files found. This might affect the saving process.")
-    else:
-        print(f"'{ARTIST_FILE}' not found. Starting new data retrieval.")
-        initialize_results_file("results.csv")
-        tags_input = input("Please enter the tags to search for (e.g., 'rock,pop'): ").strip()
-        tags = tags_input.split(',')
-        try:
-            process_tags(tags)
-        except Exception as e:
-            print(f"Error in main (code2): {str(e)}")
-
-    if os.path.exists(ARTIST_FILE):
-        with open(ARTIST_FILE, "r", encoding="utf-8") as csvfile:
-            reader = csv.DictReader(csvfile)
-            fieldnames = reader.fieldnames
-            all_rows = list(reader)
 
-        if "PROCESSED" not in fieldnames:
-            fieldnames.append("PROCESSED")
-            with open(ARTIST_FILE, "w", newline='', encoding="utf-8") as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-                for row in all_rows:
-                    row["PROCESSED"] = "No"
-                    writer.writerow(row)
-
-        # Initialize tracks_to_search here
-        tracks_to_search = []
-        with open(ARTIST_FILE, "r", encoding="utf-8") as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                if row.get("PROCESSED", "No") == "No":
-                    year = row.get("Year", "")
-                    year = int(year) if year.isdigit() else year
-                    isrc = row.get("ISRC", "")
-                    tracks_to_search.append((row["Artist"], row["Title"], year, isrc))
-
-        total_tracks = len(tracks_to_search)
-        processed_count = get_retrieved_tracks_count("results.csv")
-        total_tracks = min(len(tracks_to_search), max_tracks)
-        processed_tracks = 0
-        goal_tracks = max_tracks
-        access_token = get_spotify_access_token()
-        headers = {"Authorization": f"Bearer {access_token}"}
-
-        existing_track_ids = set()
-        start_time = time.time()
-        track_times = []
-        api_call_count = 0
-        call_start_time = time.time()
 
+def is_tag_file(filename):
+    """True for a tag file written by the harvester, which starts with an Artist,Title header."""
+    with open(filename, "r", newline="", encoding="utf-8") as csvfile:
+        return next(csv.reader(csvfile), None) == ["Artist", "Title"]
+
+
+def result_row_for(selected_track, year):
+    """Build the results.csv row for a selected track; `year` from artist.csv wins over the album's."""
+    release_year = selected_track["album"]["release_date"][:4] if not year else year
+    return [
+        int(release_year),
+        f"{SPOTIFY_TRACK_URL}{selected_track['id']}",
+        selected_track["name"],
+        selected_track["artists"][0]["id"],
+        selected_track["artists"][0]["name"],
+        selected_track["album"]["id"],
+        selected_track["popularity"],
+    ]
+
+
+def match_tracks(rows, tags, max_tracks, storage, compact_journal=True, manifest=None):
+    """Match (artist, title, year, isrc) rows on Spotify and store the results for `tags`.
+
+    `rows` may be any iterable, including a HarvestStream that is still
+    being filled. Pass compact_journal=False while the CSV backend's
+    artist.csv is being written by the harvester; checkpoints then only
+    make the journal durable. With a `manifest`, every searched row is
+    recorded in it and it is saved at each checkpoint and on the way out.
+    """
+    storage.begin_matching(tags, compact_journal)
+    processed_count = storage.result_count()
+    processed_tracks = 0
+    goal_tracks = max_tracks
+    tokens = SpotifyTokenManager()
+
+    eta = EwmaEta()
+
+    # Searches run ahead on a worker pool; only rows we can still use are submitted
+    limiter = AdaptiveRateLimiter("spotify", SPOTIFY_REQUESTS_PER_SECOND, SPOTIFY_MAX_REQUESTS_PER_SECOND)
+    remaining_rows = islice(rows, max(max_tracks - processed_count, 0))
+    cache = SpotifyMatchCache(MATCH_CACHE_FILE)
+    lookup_stats = LookupStats()
+    # In multi-market mode results.csv and the tag files hold the first market's matches
+    markets = SPOTIFY_MARKETS or None
+    market_results = MarketResults(markets) if markets else None
+    spotify_requests = metrics.counters["spotify_requests"]
+    searches = search_spotify_tracks(remaining_rows, tokens, limiter, cache, lookup_stats, markets=markets)
+
+    search_store = SearchStore(SEARCH_STORE_FILE) if SEARCH_STORE_FILE else None
+
+    try:
         # Now we can loop over tracks_to_search safely
-        for artist, title, year, isrc in tracks_to_search:
+        for (artist, title, year, isrc), tracks in searches:
             if processed_count + processed_tracks >= max_tracks:
                 print(f"Reached target number of tracks ({max_tracks}). Stopping.")
                 break
 
-            start_track_time = time.time()
             processed_tracks += 1
             total_processed = processed_count + processed_tracks
+            eta.update()
+            metrics.export()
 
             print(f"Processing track {total_processed}/{goal_tracks} ({total_processed/goal_tracks*100:.2f}%)")
             print(f"Current Track: Artist - {artist}, Title - {title}")
 
-            retry_attempts = 5
-            tracks = None
-            for attempt in range(retry_attempts):
-                try:
-                    tracks = get_spotify_tracks(artist, title, headers)
-                    if not tracks:
-                        print(f"No results found for artist {artist}, track {title}.")
-                        update_processed_status(ARTIST_FILE, title)
-                        break
-
-                    # Filter out live versions
-                    exact_artist_tracks = [track for track in tracks if track["artists"][0]["name"].strip().lower() == artist.strip().lower()]
-                    non_live_tracks = [track for track in exact_artist_tracks if not is_live_track(track["name"])]
-                    live_tracks = [track for track in exact_artist_tracks if is_live_track(track["name"])]
-                    break  # Success, exit retry loop
-
-                except TypeError as e:
-                    print(f"TypeError on attempt {attempt + 1}/{retry_attempts}: {str(e)}")
-                    if attempt == retry_attempts - 1:
-                        print("Max retry attempts reached. Skipping track.")
-                        update_processed_status(ARTIST_FILE, title)
-                        continue
-                    else:
-                        print(f"Retrying after error (attempt {attempt + 1}/{retry_attempts})...")
-                        time.sleep(2 ** attempt)  # Exponential backoff on retries
-
-
             if not tracks:
+                print(f"No results found for artist {artist}, track {title}.")
+                metrics.increment("tracks_unmatched")
+                if manifest is not None:
+                    manifest.record_match(artist, title, matched=False)
                 continue
+            if search_store is not None:
+                search_store.write(artist, title, year, isrc, tags, tracks, markets)
 
-            # Choose the track with the oldest release year and highest popularity
-            selected_track = None
-            if non_live_tracks:
-                selected_track = min(non_live_tracks, key=track_sort_key)
-            elif live_tracks:
-                selected_track = min(live_tracks, key=track_sort_key)
-
+            with metrics.time("selection"):
+                if market_results is None:
+                    selected_track = select_spotify_track(tracks, preprocess_artist_name(artist))
+                else:
+                    selected_track = market_results.select(tracks, artist, year)
             if not selected_track:
                 print(f"No suitable tracks found for artist {artist}, track {title}.")
-                update_processed_status(ARTIST_FILE, title)  # Mark as "No" if not found
+                metrics.increment("tracks_unmatched")
+                if manifest is not None:
+                    manifest.record_match(artist, title, matched=False)
                 continue
+            metrics.increment("tracks_matched")
+
+            storage.add_result(result_row_for(selected_track, year))
+
+            # Results become durable before their tracks are recorded as processed
+            storage.mark_processed(artist, title)
+            if manifest is not None:
+                manifest.record_match(artist, title, matched=True)
+            if storage.checkpoint_due or (manifest is not None and manifest.due):
+                if search_store is not None:
+                    search_store.checkpoint()
+                if market_results is not None:
+                    market_results.checkpoint()
+                storage.checkpoint(manifest)
+
+            estimated_time_remaining = eta.remaining(max_tracks - total_processed) / 60
+            print(f"Estimated time remaining: {estimated_time_remaining:.2f} minutes")
+            print(f"Match cache: {cache.hits} hits, {cache.misses} misses")
+    finally:
+        searches.close()
+        print(f"Lookups: {lookup_stats.counts['isrc']} by ISRC, {lookup_stats.counts['query']} by artist/title query")
+        print(f"Spotify searches avoided: {lookup_stats.counts['shared'] + cache.hits} ({lookup_stats.counts['shared']} "
+              f"shared with a search in flight, {cache.hits} served from the local match index)")
+        # Not counted as avoided: a collapsed spelling past max_tracks would never have been searched
+        print(f"Near-duplicate spellings collapsed at harvest: {metrics.counters['harvest_near_duplicates']}")
+        if market_results is not None:
+            print(market_results.summary(metrics.counters["spotify_requests"] - spotify_requests))
+            market_results.close()
+        cache.close()
+        if search_store is not None:
+            search_store.close()
+        if manifest is not None:  # Marks must not outlive the manifest that covers their results
+            storage.checkpoint(manifest)
+        storage.end_matching()
+        tokens.close()
+        limiter.save()
+        metrics.export(force=True)
+        print(metrics.summary())
+
+
+_rematch_result_ids = frozenset()  # Track IDs of the results being rebuilt, set in each rematch worker
+
+
+def init_rematch_worker(result_ids):
+    global _rematch_result_ids
+    _rematch_result_ids = result_ids
+
+
+def rematch_chunk(lines, policy=DEFAULT_POLICY):
+    """Rank stored searches in one batch under `policy`; executed in a worker process.
+
+    A search made in multi-market mode is ranked once per market, over the
+    items available there, as MarketResults.select() does; its result row
+    is the first market's. Returns (artist, title, tags, result_row,
+    {market: result_row}) matches and the Track IDs of current results
+    that appear among the searches' items, i.e. that the store accounts for.
+    """
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:  # A torn last line after a crash
+            continue
+    result_sets = []
+    for record in records:
+        artist = preprocess_artist_name(record["artist"])
+        for market in record.get("markets") or [None]:
+            items = record["items"] if market is None else [item for item in record["items"] if market in item.get("available_markets", ())]
+            result_sets.append((artist, items))
+    choices = iter(rank_result_sets(result_sets, policy))
+    matches = []
+    for record in records:
+        markets = record.get("markets") or [None]
+        rows = {
+            market: result_row_for(selected_track, record["year"]) if selected_track else None
+            for market, selected_track in zip(markets, choices)
+        }
+        market_rows = {market: row for market, row in rows.items() if market is not None and row is not None}
+        matches.append((record["artist"], record["title"], record["tags"], rows[markets[0]], market_rows))
+    accounted = {
+        track_id_url for record in records for item in record["items"]
+        if (track_id_url := f"{SPOTIFY_TRACK_URL}{item['id']}") in _rematch_result_ids
+    }
+    return matches, accounted
+
+
+def rewrite_csv(filename, rows):
+    temp_file = f"{filename}.tmp"
+    with open(temp_file, "w", newline="", encoding="utf-8") as csvfile:
+        csv.writer(csvfile).writerows(rows)
+    os.replace(temp_file, filename)
+
+
+def market_result_files():
+    """Map each market with a results file in MARKET_RESULTS_DIR to its filename."""
+    if not os.path.isdir(MARKET_RESULTS_DIR):
+        return {}
+    return {
+        os.path.splitext(name)[0]: os.path.join(MARKET_RESULTS_DIR, name)
+        for name in sorted(os.listdir(MARKET_RESULTS_DIR)) if name.endswith(".csv")
+    }
+
+
+def read_result_rows(filename):
+    """Return the result rows of a results-style CSV, skipping its header."""
+    with open(filename, "r", newline="", encoding="utf-8") as csvfile:
+        return [row for row in csv.reader(csvfile) if len(row) == len(RESULTS_HEADER) and row[1].startswith(SPOTIFY_TRACK_URL)]
+
+
+def refresh_result_files(filenames, updated):
+    """Replace the result rows of CSV files that repeat results.csv rows (tag and market files) by Track ID."""
+    for filename in filenames:
+        if not os.path.exists(filename):
+            continue
+        with open(filename, "r", newline="", encoding="utf-8") as csvfile:
+            rows = [
+                updated.get(row[1], row) if len(row) == len(RESULTS_HEADER) else row
+                for row in csv.reader(csvfile)
+            ]
+        rewrite_csv(filename, rows)
+
+
+def rematch(store_file=None, workers=None, storage=None, policy=None):
+    """Rebuild the stored results and tag results from the search store with the current selection rules.
+
+    Makes no network calls. Stored searches are ranked in batches with
+    ranking.rank_result_sets() in parallel across `workers` processes (all
+    CPU cores by default); `policy` lists the ranking columns in priority
+    order and defaults to ranking.DEFAULT_POLICY, which picks what
+    select_spotify_track() would. When a track was searched more than once,
+    its latest search wins. Harvested Artist/Title rows in the tag files
+    are kept, their result rows are replaced. The per-market files of
+    searches made in multi-market mode are rebuilt the same way. Results whose track is in
+    none of the stored searches, such as rows matched before the store
+    existed or with it disabled, cannot be rebuilt and are kept as they are.
+    """
+    policy = tuple(policy or DEFAULT_POLICY)
+    unknown = [column for column in policy if column not in DEFAULT_POLICY]
+    if unknown:
+        raise ValueError(f"Unknown ranking column(s) {', '.join(unknown)}; choose from {', '.join(DEFAULT_POLICY)}")
+    store_file = store_file or SEARCH_STORE_FILE
+    if not store_file or not os.path.exists(store_file):
+        print(f"No search store found at '{store_file}'. Run a match with SEARCH_STORE_FILE set first.")
+        return
+
+    start_time = time.time()
+    storage = storage or open_storage()
+    market_files = market_result_files()
+    existing_market_rows = {market: read_result_rows(filename) for market, filename in market_files.items()}
+    result_ids = frozenset(row[1] for rows in [storage.result_rows(), *existing_market_rows.values()] for row in rows)
+    accounted = set()
+    matches = {}
+    chunks = []
+    chunk = []
+    for line in read_search_store(store_file):
+        chunk.append(line)
+        if len(chunk) >= REMATCH_CHUNK_LINES:
+            chunks.append(chunk)
+            chunk = []
+    if chunk:
+        chunks.append(chunk)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_rematch_worker, initargs=(result_ids,)) as executor:
+        for chunk_matches, chunk_accounted in executor.map(partial(rematch_chunk, policy=policy), chunks):
+            accounted |= chunk_accounted
+            for artist, title, tags, result_row, market_rows in chunk_matches:
+                matches.pop((artist, title), None)  # Keep the latest search, in the order it was made
+                matches[(artist, title)] = (tags, result_row, market_rows)
+
+    matched = [(tags, result_row) for tags, result_row, _ in matches.values() if result_row is not None]
+    kept = result_ids - accounted
+    try:
+        unique_tracks, tag_count = storage.replace_results(matched, kept)
+    finally:
+        storage.close()
+
+    rebuilt_markets = defaultdict(list)
+    for _, _, market_rows in matches.values():
+        for market, result_row in market_rows.items():
+            rebuilt_markets[market].append(result_row)
+    if rebuilt_markets:
+        os.makedirs(MARKET_RESULTS_DIR, exist_ok=True)
+    for market, rows in rebuilt_markets.items():
+        market_results = [row for row in existing_market_rows.get(market, []) if row[1] in kept]
+        seen_track_ids = {row[1] for row in market_results}
+        for result_row in rows:
+            if result_row[1] not in seen_track_ids:
+                seen_track_ids.add(result_row[1])
+                market_results.append(result_row)
+        rewrite_csv(os.path.join(MARKET_RESULTS_DIR, f"{market}.csv"), [RESULTS_HEADER] + market_results)
+    if kept:
+        print(f"Warning: {len(kept)} results are not in any stored search (matched before '{store_file}' existed "
+              f"or with it disabled) and were kept as they were.")
+    print(f"Rematched {len(matches)} stored searches in {time.time() - start_time:.2f} seconds: "
+          f"{len(matched)} matched, {unique_tracks} unique tracks in the results, {tag_count} tags rewritten"
+          + (f", {len(rebuilt_markets)} market files rebuilt." if rebuilt_markets else "."))
+
+
+class ResultsEnricher:
+    """Refreshes result rows through Spotify's multi-ID endpoints instead of repeating their searches.
+
+    Rows are handled ENRICH_CHUNK_ROWS at a time: the chunk's distinct IDs
+    are looked up in batches on a worker pool sharing one rate limiter, and
+    the rows are yielded in their original order. Track lookups refresh the
+    name, artist, album and popularity; the album's release date comes with
+    them, so /v1/albums is only called when years are refreshed alone. A
+    row whose lookup failed, or whose ID Spotify no longer knows, is passed
+    through unchanged.
+    """
+    def __init__(self, tokens, limiter, tracks=True, years=False, workers=None):
+        self.tokens = tokens
+        self.limiter = limiter
+        self.tracks = tracks
+        self.years = years
+        self.workers = workers or SPOTIFY_WORKERS
+        self.calls = 0
+        self.refreshed = 0
+        self.unchanged = 0
+
+    def __call__(self, rows):
+        rows = iter(rows)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                chunk = list(islice(rows, ENRICH_CHUNK_ROWS))
+                if not chunk:
+                    return
+                yield from self.refresh_chunk(chunk, executor)
+
+    def lookup(self, kind, ids, per_request, executor):
+        ids = list(dict.fromkeys(ids))  # Distinct, in first-seen order
+        batches = [ids[start:start + per_request] for start in range(0, len(ids), per_request)]
+        self.calls += len(batches)
+        items = {}
+        for batch_items in executor.map(lambda batch: get_spotify_items(kind, batch, self.tokens, self.limiter), batches):
+            items.update(batch_items or {})
+        return items
+
+    def refresh_chunk(self, chunk, executor):
+        tracks = {}
+        albums = {}
+        if self.tracks:
+            tracks = self.lookup("tracks", (ResultsIndex.bare_id(row[1]) for row in chunk), SPOTIFY_TRACKS_PER_REQUEST, executor)
+        elif self.years:
+            albums = self.lookup("albums", (row[5] for row in chunk), SPOTIFY_ALBUMS_PER_REQUEST, executor)
+        for result_row in chunk:
+            track = tracks.get(ResultsIndex.bare_id(result_row[1]))
+            album = albums.get(result_row[5]) or {}
+            if track is not None:
+                track_id_url = result_row[1]  # Rows stay keyed on the ID they were stored under
+                result_row = result_row_for(track, None if self.years else result_row[0])
+                result_row[1] = track_id_url
+            elif album.get("release_date"):
+                result_row = [int(album["release_date"][:4]), *result_row[1:]]
+            else:
+                self.unchanged += 1
+                yield result_row
+                continue
+            self.refreshed += 1
+            yield result_row
+
+
+def enrich(tracks=True, years=False, storage=None, workers=None):
+    """Refresh the stored results from Spotify's batch lookup endpoints in one pass.
+
+    `tracks` refreshes track names, artists, albums and popularity; `years`
+    replaces Year with the album's release year, which otherwise keeps the
+    year harvested from Last.fm. The tag files and the per-market files
+    are updated to match.
+    """
+    start_time = time.time()
+    tokens = SpotifyTokenManager()
+    limiter = AdaptiveRateLimiter("spotify", SPOTIFY_REQUESTS_PER_SECOND, SPOTIFY_MAX_REQUESTS_PER_SECOND)
+    enricher = ResultsEnricher(tokens, limiter, tracks, years, workers)
+    storage = storage or open_storage()
+    try:
+        updated = storage.update_results(enricher)
+        market_files = list(market_result_files().values())
+        for market_file in market_files:
+            # Tracks chosen only for other markets than the first are not in the results yet
+            missing = [row for row in read_result_rows(market_file) if row[1] not in updated]
+            updated.update((result_row[1], result_row) for result_row in enricher(missing))
+        refresh_result_files(market_files, updated)
+    finally:
+        storage.close()
+        tokens.close()
+        limiter.save()
+        metrics.export(force=True)
+    print(f"Enriched {enricher.refreshed} of {len(updated)} result tracks with {enricher.calls} Spotify lookups "
+          f"in {time.time() - start_time:.2f} seconds; {enricher.unchanged} were not found and kept as they were.")
 
-            track_id = selected_track["id"]
-            track_name = selected_track["name"]
-            artist_id = selected_track["artists"][0]["id"]
-            artist_name = selected_track["artists"][0]["name"]
-            album_id = selected_track["album"]["id"]
-            popularity = selected_track["popularity"]
-            release_year = selected_track["album"]["release_date"][:4] if not year else year
-            track_id_url = f"https://open.spotify.com/track/{track_id}"
-
-            # Save Spotify results into separate files based on tags
-            for tag in tags:
-                tag_file = f"{tag.strip()}.csv"
-                with open(tag_file, "a", newline="", encoding="utf-8") as tag_csvfile:
-                    writer = csv.writer(tag_csvfile)
-                    writer.writerow([int(release_year), track_id_url, track_name, artist_id, artist_name, album_id, popularity])
-
-            # Append new tracks to results.csv without removing existing tracks
-            if not remove_duplicate_tracks("results.csv", track_id_url):
-                with open("results.csv", "a", newline="", encoding="utf-8") as csvfile:
-                    writer = csv.writer(csvfile)
-                    writer.writerow([int(release_year), track_id_url, track_name, artist_id, artist_name, album_id, popularity])
-                existing_track_ids.add(track_id_url)
-
-            # Update "PROCESSED" status to "Yes" when track is found
-            update_processed_status(ARTIST_FILE, title, track_id)
-
-            track_time = time.time() - start_track_time
-            track_times.append(track_time)
 
-            api_call_count += 1
-            handle_rate_limiting()
+def main():
+    storage = open_storage()
+    try:
+        manifest = RunManifest.load(storage)
+        if manifest is not None:
+            harvest = manifest.state["harvest"]
+            harvest_progress = "harvest complete" if harvest["complete"] else f"last pages read {harvest['pages']}"
+            print(f"An interrupted run was found: tags {', '.join(manifest.state['tags'])}, {harvest_progress}, "
+                  f"{manifest.state['match']['searched']} tracks searched.")
+            if input("Do you want to resume it? (y/n): ").strip().lower() == 'y':
+                continue_run(storage, manifest)
+                return
+            manifest.finish()
+
+        # Prompt for the number of tracks to retrieve
+        while True:
+            try:
+                max_tracks = int(input("Please enter the number of Spotify tracks to retrieve: ").strip())
+                if max_tracks <= 0:
+                    print("Please enter a positive integer.")
+                else:
+                    break
+            except ValueError:
+                print("Invalid input. Please enter a valid number.")
 
-            if track_times:
-                avg_time_per_track = sum(track_times) / len(track_times)
-                remaining_tracks = max_tracks - total_processed
-                estimated_time_remaining = avg_time_per_track * remaining_tracks / 60
+        run(storage, max_tracks)
+    except RuntimeError as e:
+        print(f"Error: {str(e)}")
+    finally:
+        storage.close()
 
-                print(f"Estimated time remaining: {estimated_time_remaining:.2f} minutes")
 
+def run(storage, max_tracks):
+    """Ask whether to start afresh or resume, then harvest and match until `max_tracks` results exist."""
+    if storage.has_tracks():
+        remove_file = input("Harvested tracks from an earlier run exist. Do you want to remove them? (y/n): ").strip().lower()
+        if remove_file == 'y':
+            tags_input = input("Please enter the tags to search for (e.g., 'rock,pop'): ").strip()
+            start_run(storage, max_tracks, tags_input.split(','), fresh=True)
+        else:
+            print("Harvested tracks will not be removed. Proceeding with existing data.")
+            start_run(storage, max_tracks)
+    else:
+        print("No harvested tracks found. Starting new data retrieval.")
+        tags_input = input("Please enter the tags to search for (e.g., 'rock,pop'): ").strip()
+        start_run(storage, max_tracks, tags_input.split(','))
+
+
+def reset_job(storage):
+    """Remove the harvested tracks, results and stored searches of earlier runs, and forget any interrupted run."""
+    storage.clear_manifest()
+    if os.path.exists(LASTFM_PAGE_LOG):
+        os.remove(LASTFM_PAGE_LOG)
+    storage.reset()
+    if SEARCH_STORE_FILE and os.path.exists(SEARCH_STORE_FILE):
+        os.remove(SEARCH_STORE_FILE)
+    for market_file in market_result_files().values():
+        os.remove(market_file)
+
+
+def start_run(storage, max_tracks, tags=None, fresh=False, streaming=None):
+    """Harvest `tags` and match until `max_tracks` results exist, recording the run in a new manifest.
+
+    `fresh` clears the job with reset_job() first. Without `tags`, the tracks already harvested are
+    matched for the tags they were stored under. `streaming` defaults to
+    STREAMING_MODE.
+    """
+    if fresh:
+        reset_job(storage)
+    if tags is None:
+        # Get the tags of the earlier run when resuming
+        tags = storage.existing_tags()
+        if not tags:
+            print("Warning: No existing tags found. This might affect the saving process.")
+        harvest = False
+    else:
+        tags = list(tags)
+        shuffle_tags(tags)
+        harvest = True
+    streaming = STREAMING_MODE if streaming is None else streaming
+    manifest = RunManifest.start(storage, tags, max_tracks, harvest=harvest, streaming=harvest and streaming)
+    continue_run(storage, manifest)
+
+
+def continue_run(storage, manifest):
+    """Harvest and match as recorded in `manifest`, from wherever the run stopped.
+
+    The manifest is forgotten once the run completes. If the harvest
+    failed, the tracks it did harvest are still matched, the manifest is
+    kept so the next start picks the harvest up again, and RuntimeError is
+    raised.
+    """
+    tags = manifest.state["tags"]
+    max_tracks = manifest.state["max_tracks"]
+    if manifest.state["streaming"]:
+        # Harvest and match at the same time; the journal is compacted once the harvest has stopped.
+        # A resumed harvest replays its rows from the start, so skip the ones already dealt with.
+        stream = HarvestStream(tags, storage, manifest=manifest)
+        rows = (row for row in stream if not manifest.is_unmatched(row[0], row[1]) and not storage.is_processed(row[0], row[1]))
+        try:
+            match_tracks(rows, tags, max_tracks, storage, compact_journal=False, manifest=manifest)
+        finally:
+            stream.close()
+        if stream.error is not None:
+            raise RuntimeError(f"The harvest failed ({str(stream.error)}); run again to resume it.") from stream.error
+        manifest.finish()
+        return
+
+    harvest_error = None
+    if not manifest.state["harvest"]["complete"]:
+        try:
+            process_tags(tags, storage, manifest=manifest)
+        except Exception as e:
+            print(f"Error in main: {str(e)}")
+            harvest_error = e
+
+    if storage.has_tracks():
+        rows = [row for row in storage.pending_tracks() if not manifest.is_unmatched(row[0], row[1])]
+        match_tracks(rows, tags, max_tracks, storage, manifest=manifest)
+    if harvest_error is not None:
+        raise RuntimeError(f"The harvest failed ({str(harvest_error)}); run again to resume it.") from harvest_error
+    manifest.finish()
+
+
+@contextlib.contextmanager
+def job_directory(workdir):
+    """Run the enclosed code inside `workdir`, created if missing; None keeps the current directory.
+
+    Every file the tool reads and writes is relative to the working
+    directory, so jobs with directories of their own never share
+    artist.csv, results.csv, the journal or the run manifest. The change
+    applies to the whole process, so run concurrent jobs as separate
+    processes.
+    """
+    if workdir is None:
+        yield
+        return
+    os.makedirs(workdir, exist_ok=True)
+    previous_dir = os.getcwd()
+    os.chdir(workdir)
+    try:
+        yield
+    finally:
+        os.chdir(previous_dir)
+
+
+def configure(settings):
+    """Override module settings such as LASTFM_API_KEY, ARTIST_FILE or SPOTIFY_MARKET by name.
+
+    Names are the constants at the top of this module, matched
+    case-insensitively. An unknown name raises ValueError, so a typo in a
+    config file does not go unnoticed. Settings are read when a run starts.
+    """
+    for name, value in settings.items():
+        setting = name.upper()
+        if setting not in globals() or not setting.isupper():
+            raise ValueError(f"Unknown setting '{name}'")
+        globals()[setting] = value
+
+
+def load_config(filename):
+    """Apply the settings in a JSON config file, e.g. {"LASTFM_API_KEY": "...", "SPOTIFY_MARKET": "DE"}."""
+    with open(filename, "r", encoding="utf-8") as config_file:
+        configure(json.load(config_file))
+
+
+def harvest(tags, workdir=None, backend=None, seed=None, fresh=False):
+    """Harvest the Last.fm charts of `tags` into the job's storage; returns the number of tracks stored.
+
+    `fresh` clears the job with reset_job() first. Raises RuntimeError if
+    the harvest fails; the pages written so far are kept.
+    """
+    with job_directory(workdir):
+        storage = open_storage(backend)
+        try:
+            if fresh:
+                reset_job(storage)
+            tags = list(tags)
+            shuffle_tags(tags, seed)
+            try:
+                return sum(1 for _ in harvest_tracks(tags, storage))
+            except requests.exceptions.RequestException as e:
+                raise RuntimeError(f"The harvest failed ({str(e)}).") from e
+        finally:
+            storage.close()
+
+
+def match(rows, tags, max_tracks, workdir=None, backend=None):
+    """Match (artist, title, year, isrc) rows on Spotify until `max_tracks` results exist; returns the result count.
+
+    `rows` may be None for the harvested tracks still pending, and `tags`
+    None for the tags stored in the job's directory. Raises ValueError
+    when `rows` is None and nothing has been harvested there, and
+    RuntimeError when Spotify refuses the credentials.
+    """
+    with job_directory(workdir):
+        storage = open_storage(backend)
+        try:
+            if rows is None and not storage.has_tracks():
+                raise ValueError("No harvested tracks to match; run `harvest` first.")
+            tags = list(tags) if tags is not None else storage.existing_tags()
+            match_tracks(storage.pending_tracks() if rows is None else rows, tags, max_tracks, storage)
+            return storage.result_count()
+        finally:
+            storage.close()
+
+
+def run_job(tags, max_tracks, workdir=None, backend=None, fresh=False, streaming=None):
+    """Harvest and match without prompting; returns the number of results stored.
+
+    An interrupted run in the job's directory is resumed first, as
+    recorded in its manifest, unless `fresh` is set. Otherwise this is
+    start_run(): `tags` may be None to match the tracks already harvested,
+    but new tags are only harvested into an empty store or with `fresh`.
+    """
+    with job_directory(workdir):
+        storage = open_storage(backend)
+        try:
+            manifest = RunManifest.load(storage)
+            if manifest is not None and not fresh:
+                print(f"Resuming the interrupted run for tags {', '.join(manifest.state['tags'])}.")
+                continue_run(storage, manifest)
+            else:
+                if tags is not None and not fresh and storage.has_tracks():
+                    raise ValueError("Harvested tracks from an earlier run exist; pass fresh=True (--fresh) to harvest new tags.")
+                start_run(storage, max_tracks, tags, fresh, streaming)
+            return storage.result_count()
+        finally:
+            storage.close()
+
+
+def parse_args(argv):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--config", help="JSON file of settings, e.g. {\"LASTFM_API_KEY\": \"...\", \"ARTIST_FILE\": \"tracks.csv\"}")
+    common.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="Override one setting; VALUE is read as JSON when it parses, else as a string")
+    common.add_argument("--workdir", help="Directory for this job's files, created if missing (default: the current directory)")
+    common.add_argument("--storage", choices=["csv", "sqlite"], help="Storage backend (default: STORAGE_BACKEND)")
+
+    parser = argparse.ArgumentParser(
+        description="Harvest Last.fm tag charts and match the tracks on Spotify. Run without arguments for the interactive prompts."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", parents=[common], help="Harvest and match; resumes an interrupted run in the working directory")
+    run_parser.add_argument("--tags", help="Comma-separated tags to harvest; omit to match the tracks already harvested")
+    run_parser.add_argument("--max-tracks", type=int, required=True, help="Number of Spotify tracks to retrieve")
+    run_parser.add_argument("--fresh", action="store_true", help="Remove the tracks and results of earlier runs first")
+    run_parser.add_argument("--streaming", action="store_true", help="Match tracks while they are harvested (default: STREAMING_MODE)")
+    run_parser.add_argument("--markets", help="Comma-separated markets to match for from shared searches, e.g. PL,DE,FR (default: SPOTIFY_MARKETS)")
+    harvest_parser = commands.add_parser("harvest", parents=[common], help="Only harvest Last.fm tracks")
+    harvest_parser.add_argument("--tags", required=True, help="Comma-separated tags to harvest")
+    harvest_parser.add_argument("--seed", type=int, help="Seed for the tag order (default: HARVEST_SEED)")
+    harvest_parser.add_argument("--fresh", action="store_true", help="Remove the tracks and results of earlier runs first")
+    match_parser = commands.add_parser("match", parents=[common], help="Only match the harvested tracks still pending")
+    match_parser.add_argument("--tags", help="Comma-separated tags to write results for (default: the stored tags)")
+    match_parser.add_argument("--max-tracks", type=int, required=True, help="Number of Spotify tracks to retrieve")
+    match_parser.add_argument("--markets", help="Comma-separated markets to match for from shared searches, e.g. PL,DE,FR (default: SPOTIFY_MARKETS)")
+    rematch_parser = commands.add_parser("rematch", parents=[common], help="Rebuild the results from the stored searches offline")
+    rematch_parser.add_argument("--workers", type=int, help="Worker processes (default: all CPU cores)")
+    rematch_parser.add_argument("--policy", help=f"Comma-separated ranking columns in priority order (default: {','.join(DEFAULT_POLICY)})")
+    enrich_parser = commands.add_parser("enrich", parents=[common], help="Refresh the results through Spotify's batch lookups")
+    enrich_parser.add_argument("--refresh", choices=["tracks", "years", "all"], default="tracks",
+                               help="tracks: names, artists, albums and popularity; years: Year from the album's release date; all: both")
+    enrich_parser.add_argument("--workers", type=int, help="Lookups kept in flight (default: SPOTIFY_WORKERS)")
+    return parser.parse_args(argv)
+
+
+def parse_setting(item):
+    """Split a --set NAME=VALUE option; VALUE is JSON when it parses, a string otherwise."""
+    name, _, value = item.partition("=")
+    try:
+        return name, json.loads(value)
+    except json.JSONDecodeError:
+        return name, value
+
+
+def cli(argv):
+    """Run one command without prompts, e.g. `python lastfm2spotify.py run --tags rock --max-tracks 500 --workdir jobs/rock`.
+
+    Settings come from --config, then from the environment variables in
+    CREDENTIAL_ENV_VARS, then from --set, each overriding the one before.
+    """
+    args = parse_args(argv)
+    try:
+        if args.config:
+            load_config(args.config)
+        configure({name: os.environ[name] for name in CREDENTIAL_ENV_VARS if name in os.environ})
+        configure(dict(parse_setting(item) for item in args.set))
+        if getattr(args, "markets", None):
+            configure({"SPOTIFY_MARKETS": args.markets.split(",")})
+        tags = args.tags.split(",") if getattr(args, "tags", None) else None
+        if args.command == "run":
+            run_job(tags, args.max_tracks, args.workdir, args.storage, args.fresh, args.streaming or None)
+        elif args.command == "harvest":
+            print(f"Harvested {harvest(tags, args.workdir, args.storage, args.seed, args.fresh)} tracks.")
+        elif args.command == "match":
+            print(f"{match(None, tags, args.max_tracks, args.workdir, args.storage)} tracks in the results.")
+        elif args.command == "enrich":
+            with job_directory(args.workdir):
+                enrich(args.refresh in ("tracks", "all"), args.refresh in ("years", "all"), open_storage(args.storage), args.workers)
+        else:
+            with job_directory(args.workdir):
+                rematch(workers=args.workers, storage=open_storage(args.storage), policy=args.policy.split(",") if args.policy else None)
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 2
+    except RuntimeError as e:  # A failed harvest or a refused Spotify login; the run can be resumed
+        print(f"Error: {str(e)}")
+        return 1
+    return 0
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(cli(sys.argv[1:]))
     main()
\ No newline at end of file
@@ -0,0 +1,175 @@
+"""Normalization and ranking of Spotify search results for lastfm2spotify.
+
+canonical_track_key() reduces an artist and title to the form used to
+recognise near-duplicates. select_spotify_track() filters and scores the
+candidates of one search in a single pass. rank_result_sets() does the
+same for many stored searches at once with pandas, so cached results can
+be re-selected under a different policy without touching the API.
+"""
+import re
+import unicodedata
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+LIVE_PATTERN = re.compile('live', re.IGNORECASE)  # Substring match, so "Alive" and "Delivery" count too
+
+# "(feat. B)" / "[ft. B]" anywhere, or a trailing "feat. B"; a bare "ft." is part of names like "10 Ft. Ganja Plant"
+FEATURING_PATTERN = re.compile(
+    r"\s*[(\[](?:feat\.?|ft\.?|featuring)\s[^)\]]*[)\]]|\s+(?:feat\.|featuring)\s.*$",
+    re.IGNORECASE,
+)
+# Only reissue labels; edits, mixes and "versions" are different recordings and are never stripped
+VERSION_TAGS = r"re-?master(?:ed)?|mono|stereo|bonus track|deluxe(?: edition)?|(?:\d+(?:st|nd|rd|th) )?anniversary(?: edition)?"
+VERSION_WORD = rf"(?:{VERSION_TAGS}|(?:19|20)\d\d)"  # Years only count next to a tag
+VERSION_SUFFIX = rf"(?:{VERSION_WORD}[\s/,&]+)*(?:{VERSION_TAGS})(?:[\s/,&]+{VERSION_WORD})*"
+# "(2011 Remaster)", "[Mono]" or a trailing "- Remastered 2009", made up of nothing but version tags and years
+VERSION_PATTERN = re.compile(
+    rf"\s*[(\[]\s*{VERSION_SUFFIX}\s*[)\]]|\s+-\s+{VERSION_SUFFIX}\s*$",
+    re.IGNORECASE,
+)
+NON_WORD_PATTERN = re.compile(r"[\W_]+")
+
+# Columns compared in order, smaller is better; `popularity` is negated in the key
+DEFAULT_POLICY = ("is_live", "multiple_artists", "has_hyphen", "release_year", "popularity")
+DESCENDING_COLUMNS = {"popularity"}
+
+
+def preprocess_track_title(title):
+    """Remove featured artists and reissue tags ("2011 Remaster", "Mono") from a track title; mixes, edits and live versions stay."""
+    cleaned = VERSION_PATTERN.sub("", FEATURING_PATTERN.sub("", title)).strip()
+    return cleaned or title.strip()
+
+
+def preprocess_artist_name(artist):
+    """Drop featured artists, e.g. "A feat. B" -> "A"."""
+    cleaned = FEATURING_PATTERN.sub("", artist).strip()
+    return cleaned or artist.strip()
+
+
+@lru_cache(maxsize=65536)
+def canonical_text(text):
+    """Case-, accent- and punctuation-insensitive form of a name; "&" and "and" are the same."""
+    decomposed = unicodedata.normalize("NFKD", text)
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    canonical = " ".join(NON_WORD_PATTERN.sub(" ", stripped.casefold().replace("&", " and ")).split())
+    return canonical or text.strip().casefold()  # Names made only of punctuation
+
+
+def canonical_track_key(artist, title):
+    """Key shared by near-duplicate chart entries: case variants, "feat." credits and remaster tags."""
+    return canonical_text(preprocess_artist_name(artist)), canonical_text(preprocess_track_title(title))
+
+
+@lru_cache(maxsize=65536)
+def normalize_artist(name):
+    """Form of an artist name used to compare search results with the requested artist; both drop "feat." credits."""
+    return canonical_text(preprocess_artist_name(name))
+
+
+def is_live_track(title):
+    """Check if the track title indicates a live version."""
+    return LIVE_PATTERN.search(title) is not None
+
+
+def parse_release_year(release_date):
+    return int(release_date[:4]) if release_date else 0
+
+
+def track_sort_key(track):
+    """Define the sorting criteria for selecting the track."""
+    # Sorting order:
+    # 1. Tracks with a single artist are prioritized (`True` > `False`).
+    # 2. Tracks without a hyphen in the title are prioritized (`False` > `True` for `has_hyphen_in_title`).
+    # 3. Fallback: Older tracks by release year, then higher popularity.
+    has_single_artist = len(track.get("artists", [])) == 1
+    has_hyphen_in_title = "-" in track.get("name", "")
+    release_year = parse_release_year((track.get("album") or {}).get("release_date"))
+    return (not has_single_artist, has_hyphen_in_title, release_year, -track.get("popularity", 0))
+
+
+def select_spotify_track(tracks, artist):
+    """Pick the best search result by the requested artist, preferring studio versions.
+
+    Equivalent to splitting the artist's tracks into studio and live
+    versions and taking min(track_sort_key) of the first non-empty group,
+    but each candidate is checked and scored once, inline. Artist names are
+    compared in their canonical form, so case, accents and punctuation do
+    not matter.
+    """
+    wanted_artist = normalize_artist(artist)
+    best_track = None
+    best_key = None
+    for track in tracks:
+        artists = track["artists"]
+        if normalize_artist(artists[0]["name"]) != wanted_artist:
+            continue
+        name = track["name"]
+        release_date = (track.get("album") or {}).get("release_date")
+        key = (
+            LIVE_PATTERN.search(name) is not None,
+            len(artists) != 1,
+            "-" in name,
+            int(release_date[:4]) if release_date else 0,
+            -(track.get("popularity") or 0),  # As in candidate_frame(), a missing popularity counts as 0
+        )
+        if best_key is None or key < best_key:  # Ties keep the earlier search result, like min()
+            best_track, best_key = track, key
+    return best_track
+
+
+def map_unique(values, function):
+    """Apply `function` once per distinct value; titles, artists and dates repeat a lot across searches."""
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    return np.asarray([function(value) for value in uniques])[codes]
+
+
+def candidate_frame(result_sets):
+    """Flatten (artist, tracks) pairs into one row per candidate with the scoring columns.
+
+    Build the frame once and pass it to select_from_frame() for each
+    policy to compare; only the sort is repeated.
+    """
+    set_sizes = [len(tracks) for _, tracks in result_sets]
+    tracks = [track for _, set_tracks in result_sets for track in set_tracks]
+    set_index = np.repeat(np.arange(len(result_sets)), set_sizes)
+    wanted_artists = np.asarray([normalize_artist(artist) for artist, _ in result_sets], dtype=object)
+    names = [track.get("name", "") for track in tracks]
+    return pd.DataFrame({
+        "set_index": set_index,
+        "position": np.concatenate([np.arange(size) for size in set_sizes] or [np.empty(0, dtype=int)]),
+        "artist_match": map_unique([track["artists"][0]["name"] for track in tracks], normalize_artist) == wanted_artists[set_index],
+        "is_live": map_unique(names, is_live_track).astype(bool),
+        "multiple_artists": np.asarray([len(track.get("artists", [])) != 1 for track in tracks], dtype=bool),
+        "has_hyphen": map_unique(names, lambda name: "-" in name).astype(bool),
+        "release_year": map_unique([(track.get("album") or {}).get("release_date") or "" for track in tracks], parse_release_year).astype(int),
+        "popularity": np.asarray([track.get("popularity") or 0 for track in tracks], dtype=int),
+    })
+
+
+def select_from_frame(frame, policy=DEFAULT_POLICY):
+    """Return a Series mapping set_index to the position of the chosen candidate.
+
+    `policy` lists scoring columns in priority order; all are ascending
+    except those in DESCENDING_COLUMNS. Sets without a candidate by the
+    requested artist are absent from the result.
+    """
+    frame = frame[frame["artist_match"]]
+    ascending = [True, *(column not in DESCENDING_COLUMNS for column in policy), True]
+    # Ties go to the earlier search result, like select_spotify_track()
+    best = frame.sort_values(["set_index", *policy, "position"], ascending=ascending).drop_duplicates("set_index")
+    return pd.Series(best["position"].to_numpy(), index=best["set_index"].to_numpy())
+
+
+def rank_result_sets(result_sets, policy=DEFAULT_POLICY):
+    """Select the best track of every (artist, tracks) pair in one batch.
+
+    Returns a list aligned with `result_sets` holding the chosen track or
+    None. With the default policy the choices match select_spotify_track().
+    """
+    result_sets = list(result_sets)
+    selected = [None] * len(result_sets)
+    for set_index, position in select_from_frame(candidate_frame(result_sets), policy).items():
+        selected[set_index] = result_sets[set_index][1][position]
+    return selected
@@ -0,0 +1,47 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark  # noqa: E402
+import lastfm2spotify  # noqa: E402
+
+
+def mock_settings(base_url):
+    """Settings that point lastfm2spotify at the mock APIs with the limiters out of the way."""
+    return {
+        "LASTFM_API_URL": f"{base_url}/2.0/",
+        "SPOTIFY_API_URL": f"{base_url}/v1",
+        "SPOTIFY_AUTH_URL": f"{base_url}/api/token",
+        "LASTFM_REQUESTS_PER_SECOND": 1000,
+        "SPOTIFY_REQUESTS_PER_SECOND": 1000,
+        "SPOTIFY_MAX_REQUESTS_PER_SECOND": 1000,
+        "HARVEST_SEED": 0,
+    }
+
+
+@pytest.fixture
+def mock_api():
+    """The local stand-in for the Last.fm and Spotify APIs from benchmark.py; yields (state, base URL)."""
+    state = benchmark.MockAPIState(benchmark.parse_args(["--pages", "4", "--latency", "2", "--jitter", "0"]))
+    server = benchmark.start_mock_server(state)
+    yield state, f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+@pytest.fixture
+def tool(mock_api, monkeypatch):
+    """lastfm2spotify pointed at the mock APIs; its settings are restored after the test."""
+    for name, value in mock_settings(mock_api[1]).items():
+        monkeypatch.setattr(lastfm2spotify, name, value)
+    return lastfm2spotify
+
+
+def read_files(directory):
+    """Contents of the CSV files a job leaves in `directory`, by name."""
+    return {
+        name: open(os.path.join(directory, name), "rb").read()
+        for name in sorted(os.listdir(directory)) if name.endswith(".csv")
+    }
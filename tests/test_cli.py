@@ -0,0 +1,13 @@
+import pytest
+
+
+def test_refused_login_fails_the_run(mock_api, tool, tmp_path, monkeypatch):
+    monkeypatch.setattr(tool, "SPOTIFY_AUTH_URL", f"{mock_api[1]}/api/refused")  # Answered with a 404
+    logins = []
+    get_token = tool.get_spotify_access_token
+    monkeypatch.setattr(tool, "get_spotify_access_token", lambda: logins.append(1) or get_token())
+
+    assert tool.cli(["run", "--tags", "rock,pop", "--max-tracks", "50", "--workdir", str(tmp_path)]) == 1
+    assert len(logins) == 1  # The other workers share the refusal
+    with pytest.raises(RuntimeError, match="authentication failed"):
+        tool.match(None, None, 50, workdir=str(tmp_path))
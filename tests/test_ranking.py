@@ -0,0 +1,86 @@
+import random
+
+import pytest
+
+from ranking import canonical_track_key, preprocess_artist_name, preprocess_track_title, rank_result_sets, select_spotify_track
+
+
+@pytest.mark.parametrize("title, expected", [
+    ("Song (2011 Remaster)", "Song"),
+    ("Song [Mono]", "Song"),
+    ("Song - Remastered 2009", "Song"),
+    ("Song (25th Anniversary Edition)", "Song"),
+    ("Song (Mono / 2011 Remaster)", "Song"),
+    ("Song (feat. Guest) [2009 Remaster]", "Song"),
+    ("Song (Live at Wembley) - 2011 Remaster", "Song (Live at Wembley)"),
+])
+def test_reissue_tags_are_stripped(title, expected):
+    assert preprocess_track_title(title) == expected
+
+
+@pytest.mark.parametrize("title", [
+    "Song (Stereo Love Remix)",
+    "Song (Deluxe Club Mix)",
+    "Song - Remastered 2009 / Acoustic Version",
+    "Song (Remastered 2011 Version)",
+    "Song - Radio Edit",
+    "Song - Live",
+    "Song - 1999",
+])
+def test_other_recordings_keep_their_suffix(title):
+    assert preprocess_track_title(title) == title
+
+
+def test_near_duplicates_share_a_key():
+    assert canonical_track_key("Artist feat. Guest", "SONG - 2011 Remaster") == canonical_track_key("artist", "Song")
+    assert canonical_track_key("Artist", "Song (Club Mix)") != canonical_track_key("Artist", "Song")
+
+
+@pytest.mark.parametrize("artist, expected", [
+    ("Artist feat. Guest", "Artist"),
+    ("Artist featuring Guest", "Artist"),
+    ("Artist (ft. Guest)", "Artist"),
+    ("10 Ft. Ganja Plant", "10 Ft. Ganja Plant"),
+    ("Little Feat", "Little Feat"),
+])
+def test_featured_artists_are_dropped(artist, expected):
+    assert preprocess_artist_name(artist) == expected
+
+
+def test_ft_inside_a_name_is_kept():
+    assert preprocess_track_title("Six Ft. Under") == "Six Ft. Under"
+    assert canonical_track_key("10 Ft. Ganja Plant", "Song") != canonical_track_key("10", "Song")
+    tracks = [{"name": "Song", "artists": [{"name": "10 Ft. Ganja Plant"}], "album": {}, "popularity": 10}]
+    assert select_spotify_track(tracks, preprocess_artist_name("10 Ft. Ganja Plant")) is tracks[0]
+
+
+def test_featured_credits_are_compared_alike():
+    tracks = [{"name": "Song", "artists": [{"name": "Artist feat. Guest"}], "album": {}, "popularity": 10}]
+    assert select_spotify_track(tracks, "Artist") is tracks[0]
+    assert rank_result_sets([("Artist", tracks)]) == [tracks[0]]
+
+
+def random_result_sets(seed, count):
+    rng = random.Random(seed)
+    artists = ["Artist", "ARTIST", "Ártist", "Other", "Artist & Co"]
+    names = ["Song", "Song - Live", "Song - Remix", "Alive", "Song (Live)"]
+    result_sets = []
+    for _ in range(count):
+        tracks = []
+        for index in range(rng.randint(0, 12)):
+            tracks.append({
+                "id": f"{len(result_sets)}-{index}",
+                "name": rng.choice(names),
+                "popularity": rng.choice([None, 0, 10, 50, 50, 90]),
+                "artists": [{"name": rng.choice(artists)} for _ in range(rng.randint(1, 3))],
+                "album": {"release_date": rng.choice(["", "1999", "1999-05-01", "2005-01-01", None])},
+            })
+        result_sets.append((rng.choice(artists[:3] + ["Nobody"]), tracks))
+    return result_sets
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_batched_ranking_matches_single_pass_selection(seed):
+    result_sets = random_result_sets(seed, 1000)
+    expected = [select_spotify_track(tracks, artist) for artist, tracks in result_sets]
+    assert rank_result_sets(result_sets) == expected
@@ -0,0 +1,100 @@
+import contextlib
+import csv
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+
+import pytest
+
+import lastfm2spotify
+from conftest import mock_settings, read_files
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lastfm2spotify.py")
+MAX_TRACKS = 300
+KILLS = 4
+
+
+def run_command(base_url, workdir, backend, streaming, kill_after=None):
+    """Run the `run` command in a child process; returns its exit status, or None if it was killed first."""
+    settings = dict(mock_settings(base_url), MANIFEST_INTERVAL=0.05, JOURNAL_CHECKPOINT_INTERVAL=25, CSV_FLUSH_ROWS=7)
+    argv = [sys.executable, SCRIPT, "run", "--tags", "rock,pop,jazz", "--max-tracks", str(MAX_TRACKS),
+            "--workdir", str(workdir), "--storage", backend]
+    argv += [f"--set={name}={value}" for name, value in settings.items()]
+    if streaming:
+        argv.append("--streaming")
+    child = subprocess.Popen(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        return child.wait(timeout=kill_after or 300)
+    except subprocess.TimeoutExpired:
+        child.kill()  # SIGKILL: no cleanup runs
+        child.wait()
+        return None
+
+
+def finished(workdir, backend):
+    """True once the job in `workdir` has results and no unfinished run; a kill can land after the run completed."""
+    if backend == "csv":
+        return os.path.exists(workdir / "results.csv") and not os.path.exists(workdir / lastfm2spotify.RUN_MANIFEST_FILE)
+    database = workdir / lastfm2spotify.STORAGE_DB_FILE
+    if not os.path.exists(database):
+        return False
+    with contextlib.closing(sqlite3.connect(database)) as connection:
+        try:
+            manifest = connection.execute("SELECT 1 FROM run_state WHERE name = 'manifest'").fetchone()
+            results = connection.execute("SELECT 1 FROM results LIMIT 1").fetchone()
+        except sqlite3.OperationalError:  # Killed before the tables were created
+            return False
+    return manifest is None and results is not None
+
+
+def result_rows(filename):
+    with open(filename, "r", newline="", encoding="utf-8") as csvfile:
+        return [row for row in csv.reader(csvfile) if len(row) == 7 and row[0] != "Year"]
+
+
+@pytest.mark.parametrize("backend", ["csv", "sqlite"])
+@pytest.mark.parametrize("streaming", [False, True], ids=["two-phase", "streaming"])
+def test_killed_run_resumes_without_duplicates(mock_api, tmp_path, backend, streaming):
+    state, base_url = mock_api
+    started = time.monotonic()
+    assert run_command(base_url, tmp_path / "reference", backend, streaming) == 0
+    duration = time.monotonic() - started  # Kills land within a run however fast the machine is
+    reference = read_files(tmp_path / "reference")
+    reference_searches = state.calls["spotify_search"]
+
+    rng = random.Random(f"{backend}-{streaming}")
+    workdir = tmp_path / "killed"
+    kills = 0
+    while kills < KILLS:
+        status = run_command(base_url, workdir, backend, streaming, kill_after=rng.uniform(0.1, 0.6) * duration)
+        if status is not None:
+            assert status == 0
+            break
+        if finished(workdir, backend):
+            break
+        kills += 1
+    else:
+        assert run_command(base_url, workdir, backend, streaming) == 0
+    assert kills > 0, "every run finished before it could be killed"
+    resumed = read_files(workdir)
+
+    assert not os.path.exists(workdir / "run_manifest.json")
+    assert set(resumed) == set(reference)
+    for name in resumed:
+        rows = result_rows(workdir / name)
+        assert len({row[1] for row in rows}) == len(rows), f"duplicate results in {name}"
+        if streaming:
+            # How far the harvester runs ahead of matching depends on timing, so only the results must agree
+            assert sorted(rows) == sorted(result_rows(tmp_path / "reference" / name)), name
+        else:
+            assert resumed[name] == reference[name], name
+    with open(workdir / "artist.csv", "r", newline="", encoding="utf-8") as csvfile:
+        harvested = [(row["Artist"], row["Title"]) for row in csv.DictReader(csvfile)]
+    assert len(set(harvested)) == len(harvested), "duplicate harvested tracks"
+    assert len(result_rows(workdir / "results.csv")) == MAX_TRACKS
+    # Searches made before a kill are answered by the match cache; only those in flight are repeated
+    searches = state.calls["spotify_search"] - reference_searches
+    assert searches <= reference_searches + kills * lastfm2spotify.SPOTIFY_WORKERS
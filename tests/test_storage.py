@@ -0,0 +1,36 @@
+import os
+import shutil
+
+import pytest
+
+import lastfm2spotify
+from conftest import read_files
+
+TAGS = ["rock", "pop", "jazz"]
+
+
+def test_sqlite_export_matches_csv_backend(tool, tmp_path):
+    for backend in ("csv", "sqlite"):
+        tool.run_job(TAGS, 150, workdir=str(tmp_path / backend), backend=backend)
+    csv_files = read_files(tmp_path / "csv")
+    assert set(csv_files) == {"artist.csv", "results.csv", "rock.csv", "pop.csv", "jazz.csv"}
+    assert read_files(tmp_path / "sqlite") == csv_files
+
+
+@pytest.mark.parametrize("backend", ["csv", "sqlite"])
+def test_fresh_run_starts_from_an_empty_job(tool, tmp_path, backend):
+    tool.run_job(["rock", "pop"], 30, workdir=str(tmp_path / "clean"), backend=backend)
+    tool.run_job(TAGS, 60, workdir=str(tmp_path / "reused"), backend=backend)
+    tool.run_job(["rock", "pop"], 30, workdir=str(tmp_path / "reused"), backend=backend, fresh=True)
+    assert read_files(tmp_path / "reused") == read_files(tmp_path / "clean")  # jazz.csv included
+
+
+def test_sqlite_import_round_trip(tool, tmp_path):
+    tool.run_job(TAGS, 150, workdir=str(tmp_path / "csv"), backend="csv")
+    shutil.copytree(tmp_path / "csv", tmp_path / "imported")
+    with tool.job_directory(str(tmp_path / "imported")):
+        storage = tool.open_storage("sqlite")  # An empty database imports the CSV files
+        assert storage.result_count() == 150
+        storage.close()  # ...and exports them again
+    assert read_files(tmp_path / "imported") == read_files(tmp_path / "csv")
+    assert os.path.exists(tmp_path / "imported" / lastfm2spotify.STORAGE_DB_FILE)
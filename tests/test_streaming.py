@@ -0,0 +1,15 @@
+import pytest
+
+TAGS = ["rock", "pop", "jazz"]
+
+
+@pytest.mark.parametrize("max_tracks", [300, 1000])
+def test_streaming_harvest_stops_with_matching(mock_api, tool, tmp_path, max_tracks):
+    state, _ = mock_api
+    state.pages = 2000  # Far more chart than the run needs
+    tool.run_job(list(TAGS), max_tracks, workdir=str(tmp_path), streaming=True)
+
+    # Rows matched or buffered on the way, a queue of under two pages per tag and the pages in flight
+    rows = max_tracks + tool.STREAM_QUEUE_SIZE + tool.SPOTIFY_WORKERS
+    bound = rows / tool.TRACKS_PER_PAGE + 2 * len(TAGS) + tool.LASTFM_MAX_IN_FLIGHT
+    assert state.calls["lastfm"] <= bound